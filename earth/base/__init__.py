@@ -1,14 +1,35 @@
+from .archive import *
+from .cache import *
+from .catalog import *
 from .database import *
+from .dedup import *
+from .encoding import *
 from .io_models import *
+from .latest import *
+from .local_store import *
+from .partition_index import *
 from .reader import *
 from .register import *
 from .register_models import *
+from .rollup import *
+from .stream import *
+from .symbols import *
 from .writer import *
 
+from earth.settings import STORAGE_BACKEND
+
 
 class Earth:
-    def __init__(self):
-        self.db = Database()
+    def __init__(self, backend=STORAGE_BACKEND):
+        if backend == "local":
+            # memory mapped files, no database connection
+            self.db = None
+
+            store = LocalStore()
+            self.writer = LocalWriter(store)
+            self.reader = LocalReader(store)
+        else:
+            self.db = Database()
 
-        self.writer = Writer()
-        self.reader = Reader()
+            self.writer = Writer()
+            self.reader = Reader()
@@ -0,0 +1,158 @@
+import numpy as np
+
+from earth.base.database import Database
+from earth.base.encoding import decode_tick_chunk, encode_tick_chunk
+from earth.settings import ARCHIVE_CHUNK_SIZE, ARCHIVE_TABLE, SCHEMA_NAME
+
+
+class TickArchive:
+    """
+    earth.archive, closed partitions re-encoded as compressed chunks
+    of ARCHIVE_CHUNK_SIZE ticks, see encode_tick_chunk
+    """
+
+    def __init__(self, chunk_size=ARCHIVE_CHUNK_SIZE):
+        self.db = Database()
+
+        self.chunk_size = chunk_size
+        self.created = False
+
+    @property
+    def full_table_name(self):
+        return SCHEMA_NAME + "." + ARCHIVE_TABLE
+
+    def create_table(self):
+        if self.created:
+            return
+
+        self.db.run_query("""
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                table_name text NOT NULL,
+                chunk_no integer NOT NULL,
+                row_count integer NOT NULL,
+                min_event_at timestamp NOT NULL,
+                max_event_at timestamp NOT NULL,
+                data bytea NOT NULL,
+                PRIMARY KEY (table_name, chunk_no)
+            )
+        """.format(table_name=self.full_table_name))
+
+        self.created = True
+
+    ###########################
+
+    def write(self, table, event_at, current_value, current_volume, conn=None):
+        """
+        Stores sorted tick arrays of the partition, returns the number of chunks
+        """
+        rows = []
+
+        for chunk_no, start in enumerate(range(0, len(event_at), self.chunk_size)):
+            chunk = slice(start, start + self.chunk_size)
+
+            rows.append((
+                table.name, chunk_no, len(event_at[chunk]),
+                event_at[chunk][0].item(), event_at[chunk][-1].item(),
+                encode_tick_chunk(event_at[chunk], current_value[chunk], current_volume[chunk]),
+            ))
+
+        if rows:
+            self.db.insert_rows(self.full_table_name, ["table_name", "chunk_no", "row_count", "min_event_at",
+                                                       "max_event_at", "data"], rows, conn=conn)
+
+        return len(rows)
+
+    def read(self, table, start_date=None, end_date=None, conn=None, limit=None, ascending=True):
+        """
+        (event_at, current_value, current_volume) arrays in [start_date, end_date]
+        in the given order, only the chunks overlapping the range are fetched.
+        With a limit chunks are fetched one by one, newest first for descending
+        reads, until enough ticks are decoded.
+        """
+        limited = limit and type(limit) is int
+
+        chunks = []
+        row_count = 0
+
+        for chunk in self.iter_chunks(table, start_date, end_date, ascending, itersize=1 if limited else None,
+                                      conn=conn):
+            chunks.append(chunk)
+            row_count += len(chunk[0])
+
+            if limited and row_count >= limit:
+                break
+
+        if not chunks:
+            return np.empty(0, dtype="datetime64[us]"), np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+
+        arrays = tuple(np.concatenate(arrays) for arrays in zip(*chunks))
+
+        return tuple(array[:limit] for array in arrays) if limited else arrays
+
+    def iter_chunks(self, table, start_date=None, end_date=None, ascending=True, itersize=1, conn=None):
+        """
+        Yields the decoded chunks overlapping the range in the given order,
+        itersize chunks per query (all of them with None), no connection
+        is held between the queries
+        """
+        where_stmts = ["table_name = %s"]
+        payload = [table.name]
+
+        if start_date is not None:
+            where_stmts.append("max_event_at >= %s")
+            payload.append(start_date)
+
+        if end_date is not None:
+            where_stmts.append("min_event_at <= %s")
+            payload.append(end_date)
+
+        direction = "ASC" if ascending else "DESC"
+
+        response = self.db.run_query("""
+            SELECT chunk_no FROM {table_name}
+            WHERE {where_stmt}
+            ORDER BY chunk_no {direction}
+        """.format(table_name=self.full_table_name, where_stmt=" AND ".join(where_stmts), direction=direction),
+            payload, conn=conn)
+
+        chunk_nos = [row["chunk_no"] for row in response or []]
+        itersize = itersize or max(len(chunk_nos), 1)
+
+        for index in range(0, len(chunk_nos), itersize):
+            response = self.db.run_query("""
+                SELECT data FROM {table_name}
+                WHERE table_name = %s AND chunk_no = ANY(%s)
+                ORDER BY chunk_no {direction}
+            """.format(table_name=self.full_table_name, direction=direction),
+                (table.name, chunk_nos[index:index + itersize]), conn=conn)
+
+            for row in response or []:
+                yield self.clip(decode_tick_chunk(bytes(row["data"])), start_date, end_date, ascending)
+
+    def clip(self, chunk, start_date, end_date, ascending):
+        event_at, current_value, current_volume = chunk
+
+        mask = np.ones(len(event_at), dtype=bool)
+
+        if start_date is not None:
+            mask &= event_at >= np.datetime64(start_date, "us")
+
+        if end_date is not None:
+            mask &= event_at <= np.datetime64(end_date, "us")
+
+        order = slice(None) if ascending else slice(None, None, -1)
+
+        return event_at[mask][order], current_value[mask][order], current_volume[mask][order]
+
+    ###########################
+
+    def remove_query(self, tables):
+        return "DELETE FROM {table_name} WHERE table_name IN ({names})".format(
+            table_name=self.full_table_name, names=", ".join("'{}'".format(table.name) for table in tables))
+
+    def remove(self, tables, conn=None):
+        tables = list(tables)
+
+        if tables:
+            self.create_table()
+            self.db.run_query(self.remove_query(tables), conn=conn)
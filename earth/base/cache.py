@@ -0,0 +1,154 @@
+import hashlib
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from earth.settings import QUERY_CACHE_MAX_BYTES, QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_TTL
+
+TABLE_PATTERN = re.compile(
+    r"\b(?:FROM|JOIN|INTO|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(?:ONLY\s+)?([\w.]+)",
+    re.IGNORECASE)
+
+CATALOG_TABLE = "information_schema.tables"
+
+
+def referenced_tables(query):
+    return set(name.lower() for name in TABLE_PATTERN.findall(query))
+
+
+def estimate_size(response):
+    size = sys.getsizeof(response)
+
+    for row in response:
+        values = row.values() if isinstance(row, dict) else row
+
+        size += sys.getsizeof(row)
+        size += sum(_sizeof(value) for value in values)
+
+    return size
+
+
+def _sizeof(value):
+    # bytea columns arrive as memoryviews, getsizeof misses their buffer
+    if isinstance(value, memoryview):
+        return sys.getsizeof(value) + value.nbytes
+
+    return sys.getsizeof(value)
+
+
+class QueryCache:
+    """
+    LRU cache of SELECT results with ttl and memory cap,
+    entries are tagged with the tables they read for invalidation
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_MAX_ENTRIES, max_bytes=QUERY_CACHE_MAX_BYTES, ttl=QUERY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # key: (expires_at, size, tables, response)
+        self.entries = OrderedDict()
+        self.table_keys = defaultdict(set)
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+    ###########################
+
+    @staticmethod
+    def make_key(query, payload=None):
+        return hashlib.sha1(repr((query, payload)).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or (self.ttl and entry[0] < time.monotonic()):
+                if entry is not None:
+                    self._remove(key)
+
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[3]
+
+    def set(self, key, query, response):
+        size = estimate_size(response)
+
+        if size > self.max_bytes:
+            return
+
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        tables = referenced_tables(query)
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (expires_at, size, tables, response)
+            self.size += size
+
+            for table in tables:
+                self.table_keys[table].add(key)
+
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    ###########################
+
+    def invalidate(self, table_name):
+        with self.lock:
+            for key in list(self.table_keys.pop(table_name.lower(), ())):
+                self._remove(key)
+
+    def invalidate_query(self, query):
+        # called for writes, drops everything the statement touches
+        tables = referenced_tables(query)
+
+        if re.match(r"\s*(CREATE|DROP|ALTER)\b", query, re.IGNORECASE):
+            tables.add(CATALOG_TABLE)
+
+        for table in tables:
+            self.invalidate(table)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.table_keys.clear()
+            self.size = 0
+
+    @property
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            entries=len(self.entries),
+            size=self.size,
+        )
+
+    ###########################
+
+    def _remove(self, key):
+        _, size, tables, _ = self.entries.pop(key)
+        self.size -= size
+
+        for table in tables:
+            keys = self.table_keys.get(table)
+
+            if keys is not None:
+                keys.discard(key)
+
+                if not keys:
+                    del self.table_keys[table]
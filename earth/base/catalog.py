@@ -0,0 +1,174 @@
+from earth.base.database import Database
+from earth.base.register_models import DateRange, Label, Partition, Table
+from earth.settings import PARTITIONS_TABLE, SCHEMA_NAME, TIME_FIELD
+
+
+class PartitionCatalog:
+    """
+    earth.partitions, one row per tick table with its range and stats
+    """
+
+    def __init__(self):
+        self.db = Database()
+
+        self.created = False
+
+    @property
+    def full_table_name(self):
+        return SCHEMA_NAME + "." + PARTITIONS_TABLE
+
+    def create_table(self):
+        if self.created:
+            return
+
+        self.db.run_multiple_queries(["""
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                table_name text PRIMARY KEY,
+                label text NOT NULL,
+                range_key text NOT NULL,
+                range_start timestamp NOT NULL,
+                range_finish timestamp NOT NULL,
+                row_count bigint NOT NULL DEFAULT 0,
+                min_event_at timestamp,
+                max_event_at timestamp,
+                updated_at timestamp NOT NULL DEFAULT now()
+            )
+        """.format(table_name=self.full_table_name), """
+            ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS archived boolean NOT NULL DEFAULT false
+        """.format(table_name=self.full_table_name), """
+            ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS dirty_rows bigint NOT NULL DEFAULT 0
+        """.format(table_name=self.full_table_name), """
+            ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS sealed boolean NOT NULL DEFAULT false
+        """.format(table_name=self.full_table_name)])
+
+        self.created = True
+
+    ###########################
+
+    def load(self, cached=True):
+        """
+        [Partition, ]
+        """
+        self.create_table()
+
+        response = self.db.run_query("SELECT * FROM {}".format(self.full_table_name), cached=cached)
+
+        return [self.make_partition(row) for row in response or []]
+
+    def make_partition(self, row):
+        table = Table.from_value(
+            label=Label.from_key(row["label"]),
+            date_range=DateRange.from_values(row["range_key"], row["range_start"], row["range_finish"])
+        )
+
+        return Partition(
+            table=table,
+            row_count=row["row_count"],
+            min_event_at=row["min_event_at"],
+            max_event_at=row["max_event_at"],
+            archived=row["archived"],
+            dirty_rows=row["dirty_rows"],
+            sealed=row["sealed"])
+
+    ###########################
+
+    def record(self, table, row_count, min_event_at, max_event_at, conn=None):
+        # adds the written rows to the stats of the partition, they stay dirty until maintained
+        self.create_table()
+
+        self.db.run_query("""
+            INSERT INTO {catalog} AS p
+                (table_name, label, range_key, range_start, range_finish, row_count, min_event_at, max_event_at,
+                 dirty_rows)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (table_name) DO UPDATE
+            SET row_count = p.row_count + EXCLUDED.row_count,
+                min_event_at = LEAST(p.min_event_at, EXCLUDED.min_event_at),
+                max_event_at = GREATEST(p.max_event_at, EXCLUDED.max_event_at),
+                dirty_rows = p.dirty_rows + EXCLUDED.dirty_rows,
+                updated_at = now()
+        """.format(catalog=self.full_table_name), self.table_values(table) + (
+            row_count, min_event_at, max_event_at, row_count), conn=conn)
+
+    def remove_rows(self, table, row_count, conn=None):
+        # rows deleted by maintenance, dirty_rows is left alone and
+        # tables without a catalog row stay without one
+        self.create_table()
+
+        self.db.run_query("""
+            UPDATE {catalog} SET row_count = GREATEST(row_count - %s, 0), updated_at = now()
+            WHERE table_name = %s
+        """.format(catalog=self.full_table_name), (row_count, table.name), conn=conn)
+
+    def sync_query(self, table):
+        """
+        Recomputes the stats of a partition from the table itself
+        """
+        return """
+            INSERT INTO {catalog}
+                (table_name, label, range_key, range_start, range_finish, row_count, min_event_at, max_event_at,
+                 dirty_rows)
+            SELECT '{}', '{}', '{}', '{}'::timestamp, '{}'::timestamp,
+                   COUNT(*), MIN({time_field}), MAX({time_field}), COUNT(*)
+            FROM {table_name}
+            ON CONFLICT (table_name) DO UPDATE
+            SET row_count = EXCLUDED.row_count,
+                min_event_at = EXCLUDED.min_event_at,
+                max_event_at = EXCLUDED.max_event_at,
+                updated_at = now()
+        """.format(*self.table_values(table),
+                   catalog=self.full_table_name, time_field=TIME_FIELD, table_name=table.full_name)
+
+    def archive_query(self, table, row_count, min_event_at, max_event_at):
+        # the table is gone, its stats now describe the archived chunks
+        return """
+            UPDATE {catalog}
+            SET archived = true, row_count = {row_count}, min_event_at = '{min_event_at}',
+                max_event_at = '{max_event_at}', updated_at = now()
+            WHERE table_name = '{table_name}'
+        """.format(catalog=self.full_table_name, row_count=row_count, min_event_at=min_event_at,
+                   max_event_at=max_event_at, table_name=table.name)
+
+    def seal_query(self, table):
+        return """
+            UPDATE {catalog} SET sealed = true, updated_at = now() WHERE table_name = '{table_name}'
+        """.format(catalog=self.full_table_name, table_name=table.name)
+
+    def clean(self, dirty):
+        """
+        Subtracts the dirty row counts seen by a maintenance run,
+        rows written meanwhile keep the partition dirty
+        """
+        dirty = {table: row_count for table, row_count in dirty.items() if row_count}
+
+        if not dirty:
+            return
+
+        self.create_table()
+
+        self.db.run_query("""
+            UPDATE {catalog} AS p
+            SET dirty_rows = GREATEST(p.dirty_rows - v.row_count, 0)
+            FROM (VALUES {values}) AS v (table_name, row_count)
+            WHERE p.table_name = v.table_name
+        """.format(catalog=self.full_table_name, values=", ".join(
+            "('{}', {})".format(table.name, int(row_count)) for table, row_count in dirty.items())))
+
+    def remove_query(self, tables):
+        return "DELETE FROM {catalog} WHERE table_name IN ({names})".format(
+            catalog=self.full_table_name, names=", ".join("'{}'".format(table.name) for table in tables))
+
+    def sync(self, table, conn=None):
+        self.create_table()
+        self.db.run_query(self.sync_query(table), conn=conn)
+
+    def remove(self, tables):
+        tables = list(tables)
+
+        if tables:
+            self.create_table()
+            self.db.run_query(self.remove_query(tables))
+
+    def table_values(self, table):
+        return (table.name, table.label.machine_key, table.date_range.machine_key,
+                table.date_range.start, table.date_range.finish)
@@ -1,67 +1,248 @@
+import io
+import threading
+import uuid
+from contextlib import contextmanager
+
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from psycopg2.pool import ThreadedConnectionPool
-from slugify import slugify
 from tqdm import tqdm
 
-from earth.settings import DB_PARAMS, SCHEMA_NAME
+from earth.base.cache import CATALOG_TABLE, QueryCache
+from earth.settings import DB_PARAMS, POOL_MAX_CONNECTIONS, POOL_MIN_CONNECTIONS, SCHEMA_NAME, STREAM_ITERSIZE
 from earth.utils import Singleton
 
 
 class Database(metaclass=Singleton):
     def __init__(self):
-        self.query_cache = {}
+        self.query_cache = QueryCache()
 
         self.connection_pool = self.connect_db()
 
+        # ThreadedConnectionPool raises when it runs out of connections,
+        # callers wait here instead
+        self.connection_slots = threading.BoundedSemaphore(POOL_MAX_CONNECTIONS)
+
     def connect_db(self):
-        return ThreadedConnectionPool(1, 20, **DB_PARAMS)
+        return ThreadedConnectionPool(POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, **DB_PARAMS)
+
+    def getconn(self):
+        self.connection_slots.acquire()
+
+        try:
+            return self.connection_pool.getconn()
+        except Exception:
+            self.connection_slots.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            self.connection_pool.putconn(conn)
+        finally:
+            self.connection_slots.release()
+
+    @contextmanager
+    def transaction(self, conn=None):
+        """
+        Yields conn as is, or a pooled connection which is committed
+        (rolled back on error) and given back when the block ends
+        """
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self.getconn()
+
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
 
-    def run_query(self, query, payload=None):
+            raise
+        finally:
+            self.putconn(conn)
+
+    def run_query(self, query, payload=None, conn=None, cached=True):
         if not query:
             return None
 
-        cache_key = slugify(query)
+        is_select = query.lstrip().upper().startswith("SELECT")
+        cache_key = None
         response = None
 
-        if query.startswith("SELECT"):
-            response = self.query_cache.get(cache_key)
+        if is_select:
+            # uncached reads still refresh the entry for the next cached one
+            cache_key = self.query_cache.make_key(query, payload)
+            response = self.query_cache.get(cache_key) if cached else None
+
+            if response is not None:
+                return response
+        else:
+            self.query_cache.invalidate_query(query)
+
+        with self.transaction(conn) as active_conn:
+            cur = active_conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(query, payload)
+
+            try:
+                response = cur.fetchall()
+            except psycopg2.ProgrammingError as e:
+                if str(e) not in ['no results to fetch']:
+                    raise psycopg2.ProgrammingError
 
-        if response:
-            return response
+        if cache_key and response is not None:
+            self.query_cache.set(cache_key, query, response)
 
-        conn = self.connection_pool.getconn()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        if not is_select and conn is None:
+            # selects running until the commit may have cached the old rows,
+            # callers passing conn invalidate after their own commit
+            self.query_cache.invalidate_query(query)
+
+        return response
+
+    def stream_query(self, query, payload=None, itersize=STREAM_ITERSIZE):
+        """
+        Runs the query on a named (server side) cursor and
+        yields lists of at most itersize rows, results are not cached
+        """
+        conn = self.getconn()
+        cur = conn.cursor(name="earth_stream_" + uuid.uuid4().hex, cursor_factory=RealDictCursor)
+        cur.itersize = itersize
 
         try:
             cur.execute(query, payload)
-            conn.commit()
-            response = cur.fetchall()
-        except psycopg2.ProgrammingError as e:
-            if str(e) not in ['no results to fetch']:
-                raise psycopg2.ProgrammingError
+
+            while True:
+                rows = cur.fetchmany(itersize)
+
+                if not rows:
+                    break
+
+                yield rows
         finally:
-            self.connection_pool.putconn(conn)
+            # read only, also releases the cursor when the consumer stops early
+            if not conn.closed:
+                conn.rollback()
 
-        self.query_cache[cache_key] = response
+            self.putconn(conn)
 
-        return response
+    def copy_to(self, query, fmt="binary", conn=None):
+        """
+        COPY (query) TO STDOUT, returns the raw stream.
+        A given connection is left inside its transaction.
+        """
+        active_conn = self.getconn() if conn is None else conn
+        cur = active_conn.cursor()
+        buffer = io.BytesIO()
+
+        try:
+            cur.copy_expert("COPY ({query}) TO STDOUT WITH (FORMAT {fmt})".format(query=query, fmt=fmt), buffer)
+        finally:
+            if conn is None:
+                active_conn.rollback()
+                self.putconn(active_conn)
+
+        return buffer.getvalue()
+
+    def invalidate(self, full_table_name, created=False):
+        self.query_cache.invalidate(full_table_name)
+
+        if created:
+            self.query_cache.invalidate(CATALOG_TABLE)
+
+    def cache_stats(self):
+        return self.query_cache.stats
+
+    def insert_rows(self, full_table_name, columns, rows, conflict_field=None, conflict_action="DO NOTHING",
+                    conn=None):
+        """
+        Multi-row INSERT, rows already present on conflict_field are skipped
+        or handled by conflict_action. Returns the number of affected rows.
+        """
+        insert_query = "INSERT INTO {table_name} ({columns}) VALUES %s".format(
+            table_name=full_table_name, columns=", ".join(columns))
+
+        if conflict_field:
+            insert_query += " ON CONFLICT ({}) {}".format(conflict_field, conflict_action)
+
+        with self.transaction(conn) as active_conn:
+            cur = active_conn.cursor()
+            execute_values(cur, insert_query, rows, page_size=max(len(rows), 1))
+
+        self.invalidate(full_table_name)
+
+        return cur.rowcount
+
+    def copy_from(self, full_table_name, columns, buffer, fmt="csv", conflict_field=None, conn=None):
+        """
+        COPY FROM STDIN. With a conflict_field the rows are copied into a
+        staging table first and merged with ON CONFLICT DO NOTHING.
+        Returns the number of inserted rows.
+        """
+        column_list = ", ".join(columns)
+        staging_name = "earth_staging_" + uuid.uuid4().hex[:12]
+        copy_target = staging_name if conflict_field else full_table_name
+
+        with self.transaction(conn) as active_conn:
+            cur = active_conn.cursor()
+
+            if conflict_field:
+                cur.execute("CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP".format(
+                    staging_name, full_table_name))
+
+            cur.copy_expert("COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT {fmt})".format(
+                table_name=copy_target, columns=column_list, fmt=fmt), buffer)
+
+            if conflict_field:
+                cur.execute("""
+                    INSERT INTO {table_name} ({columns})
+                    SELECT {columns} FROM {staging_name}
+                    ON CONFLICT ({conflict_field}) DO NOTHING
+                """.format(table_name=full_table_name, columns=column_list, staging_name=staging_name,
+                           conflict_field=conflict_field))
+
+            row_count = cur.rowcount
+
+        self.invalidate(full_table_name)
+
+        return row_count
+
+    def run_autocommit(self, query):
+        """
+        For statements that can not run inside a transaction block,
+        e.g. VACUUM or CREATE INDEX CONCURRENTLY
+        """
+        self.query_cache.invalidate_query(query)
+
+        conn = self.getconn()
+        autocommit = conn.autocommit
+
+        try:
+            conn.autocommit = True
+            conn.cursor().execute(query)
+        finally:
+            conn.autocommit = autocommit
+            self.putconn(conn)
+
+        self.query_cache.invalidate_query(query)
 
-    def run_multiple_queries(self, queries):
-        return self.run_query(";".join(queries))
+    def run_multiple_queries(self, queries, conn=None):
+        return self.run_query(";".join(queries), conn=conn)
 
     def run_multiple_queries_iter(self, queries, desc=None):
         return [self.run_query(query) for query in tqdm(queries, desc=desc)]
 
     ###########################
 
-    def table_list(self, full_name=False):
+    def table_list(self, full_name=False, cached=True):
         response = self.run_query("""
             SELECT table_name 
             FROM information_schema.tables 
             WHERE table_schema = '{schema_name}'
               AND table_name LIKE '%\_\_%'
-        """.format(schema_name=SCHEMA_NAME))
+        """.format(schema_name=SCHEMA_NAME), cached=cached)
 
         if full_name is True:
             return [SCHEMA_NAME + "." + row["table_name"] for row in response]
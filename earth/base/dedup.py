@@ -0,0 +1,53 @@
+import time
+
+from earth.base.database import Database
+from earth.settings import TIME_FIELD
+
+
+class Deduplicator:
+    """
+    Removes rows sharing the key fields with one window function scan,
+    the row inserted last is kept like the former self joins did
+    """
+
+    def __init__(self, db=None):
+        # anything with run_query, e.g. venus.db for the crawler tables
+        self.db = db if db is not None else Database()
+
+    def make_query(self, full_table_name, key_fields=(TIME_FIELD,), since=None, time_field=TIME_FIELD):
+        where_stmt = "WHERE {time_field} >= '{since}'".format(
+            time_field=time_field, since=since) if since is not None else ""
+
+        return """
+            WITH removed AS (
+                DELETE FROM {table_name}
+                WHERE ctid IN (
+                    SELECT ctid FROM (
+                        SELECT ctid, ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY ctid DESC) AS row_number
+                        FROM {table_name}
+                        {where_stmt}
+                    ) AS ranked
+                    WHERE row_number > 1
+                )
+                RETURNING 1
+            )
+            SELECT COUNT(*) AS removed_count FROM removed
+        """.format(table_name=full_table_name, keys=", ".join(key_fields), where_stmt=where_stmt)
+
+    def remove(self, full_table_name, key_fields=(TIME_FIELD,), since=None, time_field=TIME_FIELD, conn=None):
+        """
+        since limits the check to the rows of the recent window.
+        Returns {"table", "removed", "seconds"}
+        """
+        started_at = time.perf_counter()
+
+        query = self.make_query(full_table_name, key_fields, since, time_field)
+
+        # venus.db.run_query takes no connection
+        response = self.db.run_query(query) if conn is None else self.db.run_query(query, conn=conn)
+
+        return dict(
+            table=full_table_name,
+            removed=response[0]["removed_count"] if response else 0,
+            seconds=time.perf_counter() - started_at,
+        )
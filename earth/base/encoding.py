@@ -0,0 +1,242 @@
+import csv
+import datetime
+import io
+import struct
+import zlib
+
+import numpy as np
+
+from earth.settings import TICK_COLUMNS
+
+PG_EPOCH = datetime.datetime(2000, 1, 1)
+PG_EPOCH_MICROS = 946684800 * 1000000
+
+BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+BINARY_TRAILER = struct.pack("!h", -1)
+
+# one fixed width record of COPY TO ... (FORMAT binary) for
+# (event_at timestamp, current_value float8, current_volume int8)
+BINARY_TICK_DTYPE = np.dtype([
+    ("field_count", ">i2"),
+    ("event_at_size", ">i4"), ("event_at", ">i8"),
+    ("current_value_size", ">i4"), ("current_value", ">f8"),
+    ("current_volume_size", ">i4"), ("current_volume", ">i8"),
+])
+
+# byte widths of the zigzag encoded deltas in archived chunks
+CHUNK_WIDTHS = np.array([0, 1, 2, 4, 8])
+CHUNK_HEADER = struct.Struct("!I")
+
+
+###########################
+
+# csv
+
+def encode_csv(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    for row in rows:
+        writer.writerow([_csv_value(row[column]) for column in columns])
+
+    buffer.seek(0)
+
+    return buffer
+
+
+def _csv_value(value):
+    # empty unquoted field is NULL for COPY csv
+    return "" if value is None else value
+
+
+###########################
+
+# binary
+
+def encode_binary(rows, columns):
+    """
+    PGCOPY binary stream, field types are taken from TICK_COLUMNS
+    """
+    buffer = io.BytesIO()
+    buffer.write(BINARY_HEADER)
+
+    encoders = [BINARY_ENCODERS[TICK_COLUMNS[column]] for column in columns]
+    field_count = struct.pack("!h", len(columns))
+
+    for row in rows:
+        buffer.write(field_count)
+
+        for column, encoder in zip(columns, encoders):
+            value = row[column]
+
+            if value is None:
+                buffer.write(struct.pack("!i", -1))
+                continue
+
+            data = encoder(value)
+            buffer.write(struct.pack("!i", len(data)))
+            buffer.write(data)
+
+    buffer.write(BINARY_TRAILER)
+    buffer.seek(0)
+
+    return buffer
+
+
+def _encode_text(value):
+    return str(value).encode("utf-8")
+
+
+def _encode_timestamp(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    delta = value - PG_EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+    return struct.pack("!q", micros)
+
+
+def _encode_float8(value):
+    return struct.pack("!d", float(value))
+
+
+def _encode_int8(value):
+    return struct.pack("!q", int(value))
+
+
+BINARY_ENCODERS = dict(
+    text=_encode_text,
+    timestamp=_encode_timestamp,
+    float8=_encode_float8,
+    int8=_encode_int8,
+)
+
+
+def decode_binary_ticks(data):
+    """
+    PGCOPY binary stream -> (event_at, current_value, current_volume) arrays,
+    the columns must be NOT NULL so that every record has the same width
+    """
+    if not data:
+        records = np.empty(0, dtype=BINARY_TICK_DTYPE)
+    else:
+        extension_size = struct.unpack_from("!i", data, 15)[0]
+        body = memoryview(data)[19 + extension_size:len(data) - len(BINARY_TRAILER)]
+
+        records = np.frombuffer(body, dtype=BINARY_TICK_DTYPE)
+
+    event_at = (records["event_at"].astype(np.int64) + PG_EPOCH_MICROS).astype("datetime64[us]")
+
+    return event_at, records["current_value"].astype(np.float64), records["current_volume"].astype(np.int64)
+
+
+###########################
+
+# archive chunks
+
+def encode_tick_chunk(event_at, current_value, current_volume):
+    """
+    Compact form of sorted tick arrays, Gorilla style but byte aligned so that
+    whole chunks are decoded with numpy: delta-of-delta timestamps and volume
+    deltas are stored in 0, 1, 2, 4 or 8 bytes, values as the meaningful bytes
+    of their XOR with the previous value
+    """
+    timestamps = event_at.astype("datetime64[us]").astype(np.int64)
+    time_deltas = np.diff(np.diff(timestamps, prepend=0), prepend=0)
+    volume_deltas = np.diff(current_volume.astype(np.int64), prepend=0)
+
+    time_codes, time_bytes = _pack_deltas(time_deltas)
+    volume_codes, volume_bytes = _pack_deltas(volume_deltas)
+    value_codes, value_bytes = _pack_xor(current_value.astype(np.float64))
+
+    return zlib.compress(b"".join([
+        CHUNK_HEADER.pack(len(timestamps)),
+        ((time_codes << 4) | volume_codes).astype(np.uint8).tobytes(),
+        value_codes.astype(np.uint8).tobytes(),
+        time_bytes, volume_bytes, value_bytes,
+    ]))
+
+
+def decode_tick_chunk(data):
+    """
+    encode_tick_chunk output -> (event_at, current_value, current_volume) arrays
+    """
+    data = zlib.decompress(data)
+    count = CHUNK_HEADER.unpack_from(data)[0]
+
+    offset = CHUNK_HEADER.size
+    delta_codes = np.frombuffer(data, dtype=np.uint8, count=count, offset=offset)
+    value_codes = np.frombuffer(data, dtype=np.uint8, count=count, offset=offset + count)
+    offset += 2 * count
+
+    time_deltas, offset = _unpack_deltas(data, delta_codes >> 4, offset)
+    volume_deltas, offset = _unpack_deltas(data, delta_codes & 15, offset)
+    value_bits, offset = _unpack_xor(data, value_codes, offset)
+
+    event_at = np.cumsum(np.cumsum(time_deltas)).astype("datetime64[us]")
+    current_value = np.bitwise_xor.accumulate(value_bits).view(np.float64)
+
+    return event_at, current_value, np.cumsum(volume_deltas)
+
+
+def _pack_deltas(deltas):
+    zigzag = ((deltas << 1) ^ (deltas >> 63)).astype(np.uint64)
+
+    codes = np.zeros(len(zigzag), dtype=np.int64)
+    codes[zigzag > 0] = 1
+    codes[zigzag >= 1 << 8] = 2
+    codes[zigzag >= 1 << 16] = 3
+    codes[zigzag >= 1 << 32] = 4
+
+    # little endian bytes, the low CHUNK_WIDTHS[code] of every row are kept
+    columns = zigzag.astype("<u8").view(np.uint8).reshape(-1, 8)
+    mask = np.arange(8) < CHUNK_WIDTHS[codes][:, None]
+
+    return codes, columns[mask].tobytes()
+
+
+def _unpack_deltas(data, codes, offset):
+    mask = np.arange(8) < CHUNK_WIDTHS[codes][:, None]
+    size = int(mask.sum())
+
+    columns = np.zeros((len(codes), 8), dtype=np.uint8)
+    columns[mask] = np.frombuffer(data, dtype=np.uint8, count=size, offset=offset)
+
+    zigzag = columns.view("<u8").reshape(-1).astype(np.uint64)
+    deltas = (zigzag >> np.uint64(1)).astype(np.int64) ^ -(zigzag & np.uint64(1)).astype(np.int64)
+
+    return deltas, offset + size
+
+
+def _pack_xor(values):
+    bits = values.astype("<f8").view("<u8").astype(np.uint64)
+    xor = bits ^ np.concatenate([np.zeros(1, dtype=np.uint64), bits[:-1]])
+
+    # big endian bytes, leading and trailing zero bytes are dropped
+    columns = xor.astype(">u8").view(np.uint8).reshape(-1, 8)
+    nonzero = columns != 0
+    filled = nonzero.any(axis=1)
+
+    leading = np.where(filled, nonzero.argmax(axis=1), 0)
+    trailing = nonzero[:, ::-1].argmax(axis=1)
+    size = np.where(filled, 8 - leading - trailing, 0)
+
+    return (leading << 4) | size, columns[_xor_mask(leading, size)].tobytes()
+
+
+def _unpack_xor(data, codes, offset):
+    mask = _xor_mask(codes >> 4, codes & 15)
+    size = int(mask.sum())
+
+    columns = np.zeros((len(codes), 8), dtype=np.uint8)
+    columns[mask] = np.frombuffer(data, dtype=np.uint8, count=size, offset=offset)
+
+    return columns.view(">u8").reshape(-1).astype(np.uint64), offset + size
+
+
+def _xor_mask(leading, size):
+    positions = np.arange(8)
+    leading = leading.astype(np.int64)[:, None]
+
+    return (positions >= leading) & (positions < leading + size.astype(np.int64)[:, None])
@@ -24,3 +24,38 @@ class Tick(Entity):
     event_at = attr.ib()
     current_value = attr.ib()
     current_volume = attr.ib()
+
+
+@attr.s(slots=True, frozen=True)
+class Candle(Entity):
+    short_code = attr.ib()
+    bucket_at = attr.ib()
+    open_value = attr.ib()
+    high_value = attr.ib()
+    low_value = attr.ib()
+    close_value = attr.ib()
+    volume = attr.ib()
+    tick_count = attr.ib()
+
+
+@attr.s(slots=True)
+class TickFrame(Entity):
+    """
+    Struct of arrays: event_at (datetime64[us]), current_value (float64),
+    current_volume (int64)
+    """
+    short_code = attr.ib()
+    event_at = attr.ib()
+    current_value = attr.ib()
+    current_volume = attr.ib()
+
+    def __len__(self):
+        return len(self.event_at)
+
+    def to_ticks(self):
+        return [
+            Tick(short_code=self.short_code, event_at=event_at,
+                 current_value=current_value, current_volume=current_volume)
+            for event_at, current_value, current_volume
+            in zip(self.event_at.tolist(), self.current_value.tolist(), self.current_volume.tolist())
+        ]
@@ -0,0 +1,100 @@
+import threading
+import time
+
+from earth.base.database import Database
+from earth.base.io_models import Tick
+from earth.base.register_models import Label
+from earth.settings import LATEST_TABLE, LATEST_TTL, SCHEMA_NAME
+from earth.utils import Singleton
+
+
+class LatestTicks(metaclass=Singleton):
+    """
+    Newest tick of every symbol, kept in memory by the writer
+    and persisted to earth.latest, re-read every LATEST_TTL seconds
+    for the ticks other writers saved
+    """
+
+    def __init__(self):
+        self.db = Database()
+
+        self.ticks = None
+        self.loaded_at = None
+        self.lock = threading.RLock()
+
+    @property
+    def full_table_name(self):
+        return SCHEMA_NAME + "." + LATEST_TABLE
+
+    ###########################
+
+    def load(self):
+        with self.lock:
+            self.create_table()
+
+            response = self.db.run_query("SELECT * FROM {}".format(self.full_table_name), cached=False)
+
+            self.ticks = {Label.make_key(row["short_code"]): Tick(**row) for row in response or []}
+            self.loaded_at = time.monotonic()
+
+    def is_expired(self):
+        return self.ticks is None or time.monotonic() - self.loaded_at > LATEST_TTL
+
+    def create_table(self):
+        self.db.run_query("""
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                short_code text PRIMARY KEY,
+                event_at timestamp NOT NULL,
+                current_value float8,
+                current_volume int8
+            )
+        """.format(table_name=self.full_table_name))
+
+    ###########################
+
+    def get(self, short_code):
+        with self.lock:
+            if self.is_expired():
+                self.load()
+
+            return self.ticks.get(Label.make_key(short_code))
+
+    def update(self, ticks):
+        # newest tick per symbol of the batch
+        newest = {}
+
+        for tick in ticks:
+            key = Label.make_key(tick.short_code)
+            current = newest.get(key)
+
+            if current is None or tick.event_at > current.event_at:
+                newest[key] = tick
+
+        with self.lock:
+            if self.is_expired():
+                self.load()
+
+            changed = []
+
+            for key, tick in newest.items():
+                current = self.ticks.get(key)
+
+                if current is None or tick.event_at > current.event_at:
+                    self.ticks[key] = tick
+                    changed.append(tick)
+
+        if changed:
+            self.save(changed)
+
+        return changed
+
+    def save(self, ticks):
+        columns = ["short_code", "event_at", "current_value", "current_volume"]
+        rows = [(tick.short_code, tick.event_at, tick.current_value, tick.current_volume) for tick in ticks]
+
+        self.db.insert_rows(self.full_table_name, columns, rows, conflict_field="short_code", conflict_action="""
+            DO UPDATE SET event_at = EXCLUDED.event_at,
+                          current_value = EXCLUDED.current_value,
+                          current_volume = EXCLUDED.current_volume
+            WHERE {table_name}.event_at < EXCLUDED.event_at
+        """.format(table_name=LATEST_TABLE))
@@ -0,0 +1,343 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from earth.base.io_models import TickFrame
+from earth.base.reader import Reader
+from earth.base.register import choose_granularity, granularity_of
+from earth.base.register_models import DateRange, Label, Table
+from earth.settings import LOCAL_STORE_PATH, PARTITION_GRANULARITY, PARTITION_INTERVALS, STREAM_ITERSIZE
+from earth.utils import interval_in_seconds
+
+# fixed width column files of a partition, event_at is epoch microseconds
+LOCAL_COLUMNS = (
+    ("event_at", np.int64),
+    ("current_value", np.float64),
+    ("current_volume", np.int64),
+)
+
+
+class LocalStore:
+    """
+    Ticks on the local disk, one directory per partition holding one
+    binary file per column: <path>/<label>/<label__range>/<column>.bin
+    Reads are read-only memory maps sliced by binary search on event_at.
+    """
+
+    def __init__(self, path=LOCAL_STORE_PATH):
+        self.path = path
+
+        # table name: (inode, (event_at, current_value, current_volume) memory maps),
+        # a partition rewritten by another process has a new directory inode
+        self.maps = {}
+        self.lock = threading.RLock()
+
+    def table_path(self, table):
+        return os.path.join(self.path, table.label.machine_key, table.name)
+
+    ###########################
+
+    def labels(self):
+        if not os.path.isdir(self.path):
+            return []
+
+        return [Label.from_key(name) for name in sorted(os.listdir(self.path))]
+
+    def tables(self, short_code):
+        """
+        [Table, ] of the label sorted by range start
+        """
+        label_path = os.path.join(self.path, Label.make_key(short_code))
+
+        if not os.path.isdir(label_path):
+            return []
+
+        # .tmp- and .old- directories belong to writes in flight or crashed
+        tables = [Table.from_key(name) for name in os.listdir(label_path)
+                  if Table.SEPARATOR in name and "." not in name]
+
+        return sorted(tables, key=lambda table: table.date_range.start)
+
+    def open(self, table):
+        # under the lock, writes of this process swap the directory while holding it
+        with self.lock:
+            try:
+                inode = os.stat(self.table_path(table)).st_ino
+                entry = self.maps.get(table.name)
+
+                if entry is None or entry[0] != inode:
+                    entry = self.maps[table.name] = (inode, tuple(
+                        self._map(os.path.join(self.table_path(table), column + ".bin"), dtype)
+                        for column, dtype in LOCAL_COLUMNS))
+            except FileNotFoundError:
+                # swapped or removed by another process meanwhile, read as empty
+                return tuple(np.empty(0, dtype=dtype) for _, dtype in LOCAL_COLUMNS)
+
+            return entry[1]
+
+    def row_count(self, table):
+        if not os.path.isdir(self.table_path(table)):
+            return 0
+
+        return len(self.open(table)[0])
+
+    def _map(self, file_path, dtype):
+        # mmap can not map empty files
+        if os.path.getsize(file_path) == 0:
+            return np.empty(0, dtype=dtype)
+
+        return np.memmap(file_path, dtype=dtype, mode="r")
+
+    ###########################
+
+    def read(self, short_code, start_date, end_date):
+        """
+        (event_at, current_value, current_volume) arrays in [start_date, end_date], ascending.
+        Views of the memory maps when a single partition is hit, copies otherwise.
+        """
+        start = np.datetime64(start_date, "us").astype(np.int64)
+        end = np.datetime64(end_date, "us").astype(np.int64)
+
+        slices = []
+
+        for table in self.tables(short_code):
+            # ticks are binned as utc, see Register.separate_ticks_to_tables
+            if table.date_range.utc_finish < start_date or table.date_range.utc_start > end_date:
+                continue
+
+            event_at, current_value, current_volume = self.open(table)
+
+            left = np.searchsorted(event_at, start, side="left")
+            right = np.searchsorted(event_at, end, side="right")
+
+            if right > left:
+                slices.append((event_at[left:right], current_value[left:right], current_volume[left:right]))
+
+        if not slices:
+            return np.empty(0, dtype="datetime64[us]"), np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+
+        if len(slices) == 1:
+            event_at, current_value, current_volume = slices[0]
+        else:
+            event_at, current_value, current_volume = (np.concatenate(arrays) for arrays in zip(*slices))
+
+        return event_at.view("datetime64[us]"), current_value, current_volume
+
+    ###########################
+
+    def write(self, table, event_at, current_value, current_volume):
+        """
+        Merges the arrays into the partition, stored rows win on equal event_at.
+        Files are written next to the partition and swapped in, open maps stay valid.
+        Returns the number of new rows.
+        """
+        event_at = np.asarray(event_at, dtype="datetime64[us]").astype(np.int64)
+        current_value = np.asarray(current_value, dtype=np.float64)
+        current_volume = np.asarray(current_volume, dtype=np.int64)
+
+        with self.lock:
+            table_path = self.table_path(table)
+            stored = self.open(table) if os.path.isdir(table_path) else None
+            stored_count = len(stored[0]) if stored is not None else 0
+
+            if stored is not None:
+                event_at, current_value, current_volume = (
+                    np.concatenate([old, new]) for old, new in zip(stored, (event_at, current_value, current_volume)))
+
+            # first occurrence of every event_at, sorted
+            event_at, index = np.unique(event_at, return_index=True)
+            columns = (event_at, current_value[index], current_volume[index])
+
+            staging_path = table_path + ".tmp-" + uuid.uuid4().hex[:12]
+            os.makedirs(staging_path)
+
+            for (column, dtype), values in zip(LOCAL_COLUMNS, columns):
+                values.astype(dtype).tofile(os.path.join(staging_path, column + ".bin"))
+
+            if stored is not None:
+                retired_path = table_path + ".old-" + uuid.uuid4().hex[:12]
+                os.rename(table_path, retired_path)
+                os.rename(staging_path, table_path)
+                shutil.rmtree(retired_path)
+            else:
+                os.rename(staging_path, table_path)
+
+            self.maps.pop(table.name, None)
+
+            return len(event_at) - stored_count
+
+    def replace(self, table, event_at, current_value, current_volume):
+        # used by the sync, the partition becomes an exact copy
+        with self.lock:
+            self.remove(table)
+
+            return self.write(table, event_at, current_value, current_volume)
+
+    def remove(self, table):
+        with self.lock:
+            self.maps.pop(table.name, None)
+
+            if os.path.isdir(self.table_path(table)):
+                shutil.rmtree(self.table_path(table))
+
+
+class LocalRegister:
+    """
+    The Register calls of the readers' users answered from a LocalStore,
+    symbol metadata stays in the database and is not known here
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    @property
+    def labels(self):
+        return set(self.store.labels())
+
+    @property
+    def tables(self):
+        return set(table for label in self.store.labels() for table in self.store.tables(label.machine_key))
+
+    def metadata_by_labels(self, labels):
+        return {}
+
+
+class LocalReader(Reader):
+    """
+    Reader over a LocalStore, no database connection is made
+    """
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else LocalStore()
+        self.register = LocalRegister(self.store)
+
+    def read_iter(self, short_code, start_date=None, end_date=None, ascending=True, chunk_size=STREAM_ITERSIZE):
+        frame = self.read_arrays(short_code, start_date, end_date, ascending=ascending)
+
+        for index in range(0, len(frame), chunk_size):
+            yield TickFrame(
+                short_code=short_code,
+                event_at=frame.event_at[index:index + chunk_size],
+                current_value=frame.current_value[index:index + chunk_size],
+                current_volume=frame.current_volume[index:index + chunk_size]).to_ticks()
+
+    def read_arrays(self, short_code, start_date=None, end_date=None, limit=None, ascending=True):
+        start_date, end_date = self.date_bounds(start_date, end_date)
+
+        event_at, current_value, current_volume = self.store.read(short_code, start_date, end_date)
+
+        # reversed and limited views, still no copy
+        order = slice(None, None, 1 if ascending else -1)
+        event_at, current_value, current_volume = event_at[order], current_value[order], current_volume[order]
+
+        if limit and type(limit) is int:
+            event_at, current_value, current_volume = event_at[:limit], current_value[:limit], current_volume[:limit]
+
+        return TickFrame(
+            short_code=short_code,
+            event_at=event_at,
+            current_value=current_value,
+            current_volume=current_volume)
+
+    def read_ohlc(self, short_code, start_date=None, end_date=None, bucket="1h", resolution=None):
+        # computed from the memory maps, there are no local rollups
+        return self.make_candles(self.read_arrays(short_code, start_date, end_date), interval_in_seconds(bucket))
+
+    def read_from_db(self, short_code, start_date, end_date, limit, ascending):
+        return self.read_arrays(short_code, start_date, end_date, limit, ascending).to_ticks()
+
+    def read_last(self, short_code, start_date=None, end_date=None):
+        response = self.read(short_code, start_date, end_date, limit=1, ascending=False)
+
+        return response[0] if response else None
+
+    def read_latest(self, short_code, start_date=None):
+        return self.read_last(short_code, start_date)
+
+    def read_many(self, short_codes, start_date=None, end_date=None, ascending=True):
+        result = {short_code: self.read(short_code, start_date, end_date, ascending=ascending)
+                  for short_code in short_codes}
+
+        return {short_code: ticks for short_code, ticks in result.items() if ticks}
+
+    def read_last_many(self, short_codes, start_date=None, end_date=None):
+        return self.read_edge_many(short_codes, start_date, end_date, ascending=False)
+
+    def read_edge_many(self, short_codes, start_date, end_date, ascending):
+        result = {short_code: self.read(short_code, start_date, end_date, limit=1, ascending=ascending)
+                  for short_code in short_codes}
+
+        return {short_code: ticks[0] for short_code, ticks in result.items() if ticks}
+
+
+class LocalWriter:
+    """
+    Writer over a LocalStore, ticks are routed to the same
+    label__range partitions as in the database
+    """
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else LocalStore()
+
+    def write(self, symbol, ticks):
+        # symbol metadata stays in the database
+        return self.write_ticks(ticks)
+
+    def write_ticks(self, ticks, workers=None):
+        return self.write_tables(self.separate_ticks_to_tables(ticks))
+
+    def write_tables(self, tables, workers=None):
+        row_count = 0
+        started_at = time.perf_counter()
+
+        for table, content in tables.items():
+            row_count += self.store.write(
+                table,
+                [tick.event_at for tick in content],
+                [np.nan if tick.current_value is None else tick.current_value for tick in content],
+                [0 if tick.current_volume is None else tick.current_volume for tick in content])
+
+        elapsed = time.perf_counter() - started_at
+
+        return dict(
+            rows=row_count,
+            seconds=elapsed,
+            rows_per_sec=row_count / elapsed if elapsed > 0 else 0.0,
+            failures=[],
+        )
+
+    def separate_ticks_to_tables(self, ticks):
+        """
+        {Table: [Tick, ]}, one granularity per label like Register.granularity
+        """
+        by_label = {}
+
+        for tick in ticks:
+            by_label.setdefault(Label.make_key(tick.short_code), []).append(tick)
+
+        tables = {}
+
+        for machine_key, content in by_label.items():
+            seconds = np.array([tick.event_at for tick in content], dtype="datetime64[s]").astype(np.int64)
+            interval_seconds = int(PARTITION_INTERVALS[self.granularity(
+                machine_key, len(content), int(seconds.max() - seconds.min()))].total_seconds())
+
+            label = Label.from_value(content[0].short_code)
+
+            for current_bin, tick in zip((seconds // interval_seconds).tolist(), content):
+                table = Table.from_value(label, DateRange.from_bin(current_bin, interval_seconds))
+                tables.setdefault(table, []).append(tick)
+
+        return tables
+
+    def granularity(self, machine_key, row_count, span_seconds):
+        local_tables = self.store.tables(machine_key)
+
+        if local_tables:
+            return granularity_of(local_tables[-1].date_range)
+
+        return PARTITION_GRANULARITY.get(machine_key) or choose_granularity(row_count, span_seconds)
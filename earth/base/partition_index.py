@@ -0,0 +1,131 @@
+import bisect
+import datetime
+import threading
+from collections import defaultdict
+
+from earth.base.register_models import Partition
+
+
+class PartitionIndex:
+    """
+    Per label list of tables sorted by range start.
+    Partitions of a label never overlap, so the finishes are sorted too.
+    """
+
+    def __init__(self, partitions=()):
+        self.starts = defaultdict(list)
+        self.partitions = defaultdict(list)
+        self.tables = set()
+        self.stats = {}
+
+        self.lock = threading.RLock()
+
+        for partition in partitions:
+            self.add(partition.table, partition)
+
+    ###########################
+
+    def add(self, table, partition=None):
+        with self.lock:
+            if table in self.tables:
+                return False
+
+            self.stats[table] = partition if partition is not None else Partition(table=table, row_count=0)
+
+            key = table.label.machine_key
+            starts = self.starts[key]
+
+            position = bisect.bisect_left(starts, table.date_range.start)
+            starts.insert(position, table.date_range.start)
+            self.partitions[key].insert(position, table)
+
+            self.tables.add(table)
+
+            return True
+
+    def remove(self, table):
+        with self.lock:
+            if table not in self.tables:
+                return False
+
+            key = table.label.machine_key
+            position = self.partitions[key].index(table)
+
+            del self.starts[key][position]
+            del self.partitions[key][position]
+
+            if not self.partitions[key]:
+                del self.starts[key]
+                del self.partitions[key]
+
+            self.tables.discard(table)
+            self.stats.pop(table, None)
+
+            return True
+
+    def remove_rows(self, table, row_count):
+        with self.lock:
+            partition = self.stats.get(table)
+
+            if partition is not None and partition.row_count is not None:
+                partition.row_count = max(partition.row_count - row_count, 0)
+
+    def record(self, table, row_count, min_event_at, max_event_at):
+        with self.lock:
+            partition = self.stats.get(table)
+
+            if partition is not None:
+                partition.record(row_count, min_event_at, max_event_at)
+
+    ###########################
+
+    def __contains__(self, table):
+        return table in self.tables
+
+    def labels(self):
+        with self.lock:
+            return set(tables[0].label for tables in self.partitions.values())
+
+    def label_tables(self, machine_key):
+        with self.lock:
+            return list(self.partitions.get(machine_key, ()))
+
+    def last_table(self, machine_key):
+        with self.lock:
+            tables = self.partitions.get(machine_key)
+
+            return tables[-1] if tables else None
+
+    def lookup(self, machine_key, start_date, end_date):
+        """
+        Tables of the label whose range intersects [start_date, end_date],
+        None when the label has no table at all
+        """
+        with self.lock:
+            tables = self.partitions.get(machine_key)
+
+            if not tables:
+                return None
+
+            # last partition starting before end_date,
+            # walk back while the partitions still reach start_date
+            position = bisect.bisect_right(self.starts[machine_key], end_date)
+            current_time = datetime.datetime.now()
+            result = []
+
+            for table in (tables[i] for i in range(position - 1, -1, -1)):
+                if table.date_range.finish < start_date:
+                    break
+
+                # closed partitions are also pruned by their actual bounds,
+                # open ones may be written by other processes meanwhile
+                closed = table.date_range.finish < current_time
+
+                if closed and not self.stats[table].intersects(start_date, end_date):
+                    continue
+
+                result.append(table)
+
+            result.reverse()
+
+            return result
@@ -1,17 +1,28 @@
 import datetime
+import heapq
+import itertools
+import math
+from collections import defaultdict
+
+import numpy as np
 
 from earth.base.database import Database
-from earth.base.io_models import Tick
+from earth.base.encoding import decode_binary_ticks
+from earth.base.io_models import Candle, Tick, TickFrame
+from earth.base.latest import LatestTicks
 from earth.base.register import Register
+from earth.base.rollup import Rollups
 from earth.exceptions import NotFound
-from earth.settings import TIME_FIELD
-from earth.utils import time_in_seconds
+from earth.settings import STORAGE_MODE, STREAM_ITERSIZE, TIME_FIELD
+from earth.utils import interval_in_seconds, time_in_seconds
 
 
 class Reader:
     def __init__(self):
         self.db = Database()
         self.register = Register()
+        self.latest = LatestTicks()
+        self.rollups = Rollups()
         self.query_builder = QueryBuilder()
 
     ##################################################################
@@ -19,6 +30,155 @@ class Reader:
     # slicers
 
     def read(self, short_code, start_date=None, end_date=None, limit=None, ascending=True):
+        start_date, end_date = self.date_bounds(start_date, end_date)
+
+        # slice the database
+        return self.read_from_db(short_code, start_date, end_date, limit, ascending)
+
+    def read_iter(self, short_code, start_date=None, end_date=None, ascending=True, chunk_size=STREAM_ITERSIZE):
+        """
+        Yields lists of at most chunk_size Ticks, memory stays constant
+        """
+        start_date, end_date = self.date_bounds(start_date, end_date)
+
+        read_query = self.make_read_query(short_code, start_date, end_date, None, ascending)
+        archived = self.iter_archived(short_code, start_date, end_date, ascending)
+
+        hot_ticks = (Tick(short_code=short_code, **row)
+                     for rows in (self.db.stream_query(read_query, itersize=chunk_size) if read_query else ())
+                     for row in rows)
+
+        # both sides are sorted, merged lazily
+        ticks = heapq.merge(archived, hot_ticks, key=lambda tick: tick.event_at, reverse=not ascending)
+
+        while True:
+            chunk = list(itertools.islice(ticks, chunk_size))
+
+            if not chunk:
+                return
+
+            yield chunk
+
+    def read_arrays(self, short_code, start_date=None, end_date=None, limit=None, ascending=True):
+        """
+        TickFrame decoded from a binary COPY stream, no per row objects
+        """
+        start_date, end_date = self.date_bounds(start_date, end_date)
+
+        read_query = self.make_read_query(
+            short_code, start_date, end_date, limit, ascending, fields=QueryBuilder.ARRAY_FIELDS)
+
+        data = self.db.copy_to(read_query) if read_query else None
+        event_at, current_value, current_volume = decode_binary_ticks(data)
+
+        frame = TickFrame(
+            short_code=short_code,
+            event_at=event_at,
+            current_value=current_value,
+            current_volume=current_volume)
+
+        archived = self.read_archived(short_code, start_date, end_date, ascending, limit)
+
+        return self.merge_frames(frame, archived, limit, ascending) if len(archived) else frame
+
+    def read_ohlc(self, short_code, start_date=None, end_date=None, bucket="1h", resolution=None):
+        """
+        [Candle, ] aggregated by the database, one row per bucket, from the raw ticks.
+        resolution="auto" reads the coarsest rollup dividing the bucket, a rollup
+        resolution like "1h" forces that one. Rollups only hold data written since
+        they exist or rebuilt by Maintenance.rebuild_rollups.
+        """
+        start_date, end_date = self.date_bounds(start_date, end_date)
+        bucket_seconds = interval_in_seconds(bucket)
+
+        if resolution == "auto":
+            resolution = self.rollups.choose(bucket_seconds)
+
+        if resolution is not None:
+            candles = self.read_rollup_ohlc(short_code, resolution, start_date, end_date, bucket_seconds)
+
+            if candles is not None:
+                return candles
+
+        try:
+            table_list = self.register.tables_by_short_code(short_code, start_date, end_date)
+        except NotFound:
+            return []
+
+        if any(self.register.is_archived(table) for table in table_list):
+            # archived chunks are aggregated here, together with the hot rows
+            return self.make_candles(self.read_arrays(short_code, start_date, end_date), bucket_seconds)
+
+        ohlc_query = self.query_builder.make_ohlc_query(
+            table_list, start_date, end_date, bucket_seconds)
+
+        response = self.db.run_query(ohlc_query) if ohlc_query else None
+
+        return [Candle(short_code=short_code, **row) for row in response or []]
+
+    def read_rollup_ohlc(self, short_code, resolution, start_date, end_date, bucket_seconds):
+        """
+        Whole rollup buckets inside the range come from the rollup, the partial
+        ones at the edges from the raw ticks. None when the rollup has no rows
+        for the range, the raw ticks answer then.
+        """
+        seconds = interval_in_seconds(resolution)
+        epoch = datetime.datetime.utcfromtimestamp(0)
+
+        inner_start = epoch + datetime.timedelta(
+            seconds=math.ceil((start_date - epoch).total_seconds() / seconds) * seconds)
+        inner_finish = epoch + datetime.timedelta(
+            seconds=math.floor((end_date - epoch).total_seconds() / seconds) * seconds)
+
+        if inner_start >= inner_finish:
+            return None
+
+        inner = self.rollups.read(short_code, resolution, inner_start, inner_finish, bucket_seconds)
+
+        if not inner:
+            return None
+
+        candles = []
+
+        # ends are inclusive, the head stops a microsecond before the rollup
+        if start_date < inner_start:
+            head = self.read_arrays(short_code, start_date, inner_start - datetime.timedelta(microseconds=1))
+            candles += self.make_candles(head, bucket_seconds)
+
+        candles += inner
+        candles += self.make_candles(self.read_arrays(short_code, inner_finish, end_date), bucket_seconds)
+
+        return self.merge_candles(candles)
+
+    def merge_candles(self, candles):
+        """
+        Joins time ordered candles of the same bucket
+        """
+        result = []
+
+        for candle in candles:
+            last = result[-1] if result else None
+
+            if last is None or last.bucket_at != candle.bucket_at:
+                result.append(candle)
+                continue
+
+            highs = [value for value in (last.high_value, candle.high_value) if value is not None]
+            lows = [value for value in (last.low_value, candle.low_value) if value is not None]
+
+            result[-1] = Candle(
+                short_code=last.short_code,
+                bucket_at=last.bucket_at,
+                open_value=last.open_value,
+                high_value=max(highs) if highs else None,
+                low_value=min(lows) if lows else None,
+                close_value=candle.close_value,
+                volume=(last.volume or 0) + (candle.volume or 0),
+                tick_count=last.tick_count + candle.tick_count)
+
+        return result
+
+    def date_bounds(self, start_date, end_date):
         # what time is it
         current_time = datetime.datetime.now()
 
@@ -30,31 +190,136 @@ class Reader:
         # determine the end date
         end_date = current_time if not end_date else end_date
 
-        # slice the database
-        return self.read_from_db(short_code, start_date, end_date, limit, ascending)
+        return start_date, end_date
 
-    def read_from_db(self, short_code, start_date, end_date, limit, ascending):
+    def make_read_query(self, short_code, start_date, end_date, limit, ascending, fields=None):
         # detect the tables to read
         # register module
         try:
             table_list = self.register.tables_by_short_code(
                 short_code, start_date, end_date)
         except NotFound:
-            return []
+            return None
 
         # query that fetches the database
         # query builder module
-        read_query = self.query_builder.make_read_query(
-            table_list, start_date, end_date, limit, ascending)
+        return self.query_builder.make_read_query(
+            self.hot_tables(table_list), start_date, end_date, limit, ascending, fields)
+
+    def read_from_db(self, short_code, start_date, end_date, limit, ascending):
+        read_query = self.make_read_query(short_code, start_date, end_date, limit, ascending)
 
         # make database query
         # database module
-        response = self.db.run_query(read_query)
+        response = self.db.run_query(read_query) if read_query else None
+        ticks = [Tick(short_code=short_code, **row) for row in response or []]
+
+        archived = self.read_archived(short_code, start_date, end_date, ascending, limit)
+
+        if not len(archived):
+            return ticks
+
+        ticks.extend(archived.to_ticks())
+        ticks.sort(key=lambda tick: tick.event_at, reverse=not ascending)
+
+        return ticks[:limit] if limit and type(limit) is int else ticks
+
+    ##################################################################
+
+    # archived partitions
+
+    def hot_tables(self, table_list):
+        # archived partitions have no table, their chunks are read by read_archived
+        return [table for table in table_list if not self.register.is_archived(table)]
+
+    def read_archived(self, short_code, start_date, end_date, ascending=True, limit=None):
+        """
+        TickFrame of the archived partitions in the range, with a limit
+        only the partitions and chunks needed for it are decoded
+        """
+        tables = self.archived_tables(short_code, start_date, end_date, ascending)
+
+        limited = limit and type(limit) is int
+        frames = [(np.empty(0, dtype="datetime64[us]"), np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64))]
+        row_count = 0
+
+        for table in tables:
+            frame = self.register.archive.read(
+                table, start_date, end_date, limit=limit - row_count if limited else None, ascending=ascending)
+
+            frames.append(frame)
+            row_count += len(frame[0])
+
+            if limited and row_count >= limit:
+                break
+
+        event_at, current_value, current_volume = (np.concatenate(arrays) for arrays in zip(*frames))
+
+        return TickFrame(
+            short_code=short_code,
+            event_at=event_at,
+            current_value=current_value,
+            current_volume=current_volume)
+
+    def iter_archived(self, short_code, start_date, end_date, ascending=True):
+        """
+        Ticks of the archived partitions in the range, one chunk
+        is decoded at a time
+        """
+        for table in self.archived_tables(short_code, start_date, end_date, ascending):
+            for event_at, current_value, current_volume in self.register.archive.iter_chunks(
+                    table, start_date, end_date, ascending):
+                yield from TickFrame(
+                    short_code=short_code,
+                    event_at=event_at,
+                    current_value=current_value,
+                    current_volume=current_volume).to_ticks()
+
+    def archived_tables(self, short_code, start_date, end_date, ascending=True):
+        try:
+            table_list = self.register.tables_by_short_code(short_code, start_date, end_date)
+        except NotFound:
+            table_list = []
+
+        # partitions are sorted and never overlap
+        tables = [table for table in table_list if self.register.is_archived(table)]
+
+        return tables if ascending else tables[::-1]
 
-        if not response:
+    def merge_frames(self, frame, other, limit, ascending):
+        order = np.argsort(np.concatenate([frame.event_at, other.event_at]), kind="stable")
+        order = order if ascending else order[::-1]
+        order = order[:limit] if limit and type(limit) is int else order
+
+        return TickFrame(
+            short_code=frame.short_code,
+            event_at=np.concatenate([frame.event_at, other.event_at])[order],
+            current_value=np.concatenate([frame.current_value, other.current_value])[order],
+            current_volume=np.concatenate([frame.current_volume, other.current_volume])[order])
+
+    def make_candles(self, frame, bucket_seconds):
+        """
+        [Candle, ] of an ascending TickFrame, same buckets as QueryBuilder.make_ohlc_query
+        """
+        if not len(frame):
             return []
 
-        return [Tick(short_code=short_code, **row) for row in response]
+        seconds = frame.event_at.astype("datetime64[s]").astype(np.int64)
+        buckets = seconds // bucket_seconds * bucket_seconds
+
+        starts = np.flatnonzero(np.concatenate([[True], buckets[1:] != buckets[:-1]]))
+        finishes = np.concatenate([starts[1:], [len(buckets)]]) - 1
+
+        columns = zip(
+            buckets[starts].astype("datetime64[s]").tolist(),
+            frame.current_value[starts].tolist(),
+            np.fmax.reduceat(frame.current_value, starts).tolist(),
+            np.fmin.reduceat(frame.current_value, starts).tolist(),
+            frame.current_value[finishes].tolist(),
+            np.add.reduceat(frame.current_volume, starts).tolist(),
+            (finishes - starts + 1).tolist())
+
+        return [Candle(frame.short_code, *column) for column in columns]
 
     ##################################################################
 
@@ -67,22 +332,144 @@ class Reader:
         return response[0] if response else None
 
     def read_last(self, short_code, start_date=None, end_date=None):
+        # without an explicit end date the latest value cache answers
+        if end_date is None:
+            tick = self.read_latest(short_code, start_date)
+
+            if tick is not None:
+                return tick
+
         response = self.read(
             short_code, start_date, end_date, limit=1, ascending=False)
 
+        if response and end_date is None:
+            self.latest.update(response)
+
         return response[0] if response else None
 
+    def read_latest(self, short_code, start_date=None):
+        start_date, end_date = self.date_bounds(start_date, None)
+        tick = self.latest.get(short_code)
+
+        if tick is not None and start_date <= tick.event_at <= end_date:
+            return tick
+
+        return None
+
     def read_all(self, short_code):
         return self.read(
             short_code, start_date=datetime.datetime(year=1970, month=1, day=1))
 
+    def read_all_iter(self, short_code, chunk_size=STREAM_ITERSIZE):
+        return self.read_iter(
+            short_code, start_date=datetime.datetime(year=1970, month=1, day=1), chunk_size=chunk_size)
+
+    ##################################################################
+
+    # batch selectors, one round trip for many symbols
+
+    def read_many(self, short_codes, start_date=None, end_date=None, ascending=True):
+        """
+        {short_code: [Tick, ]}
+        """
+        start_date, end_date = self.date_bounds(start_date, end_date)
+
+        tables_map = self.register.tables_by_short_codes(short_codes, start_date, end_date)
+        read_query = self.query_builder.make_read_many_query(
+            self.hot_tables_map(tables_map), start_date, end_date, ascending)
+
+        result = self.group_ticks(self.db.run_query(read_query) if read_query else None)
+
+        for short_code in self.archived_short_codes(tables_map):
+            ticks = result.get(short_code, []) + self.read_archived(short_code, start_date, end_date).to_ticks()
+            ticks.sort(key=lambda tick: tick.event_at, reverse=not ascending)
+
+            if ticks:
+                result[short_code] = ticks
+
+        return result
+
+    def read_first_many(self, short_codes, start_date=None, end_date=None):
+        """
+        {short_code: Tick}
+        """
+        return self.read_edge_many(short_codes, start_date, end_date, ascending=True)
+
+    def read_last_many(self, short_codes, start_date=None, end_date=None):
+        """
+        {short_code: Tick}
+        """
+        if end_date is not None:
+            return self.read_edge_many(short_codes, start_date, end_date, ascending=False)
+
+        result = {}
+        missing = []
+
+        for short_code in short_codes:
+            tick = self.read_latest(short_code, start_date)
+
+            if tick is not None:
+                result[short_code] = tick
+            else:
+                missing.append(short_code)
+
+        if missing:
+            response = self.read_edge_many(missing, start_date, end_date, ascending=False)
+            self.latest.update(response.values())
+
+            result.update(response)
+
+        return result
+
+    def read_edge_many(self, short_codes, start_date, end_date, ascending):
+        start_date, end_date = self.date_bounds(start_date, end_date)
+
+        tables_map = self.register.tables_by_short_codes(short_codes, start_date, end_date)
+        read_query = self.query_builder.make_edge_many_query(
+            self.hot_tables_map(tables_map), start_date, end_date, ascending)
+
+        grouped = self.group_ticks(self.db.run_query(read_query) if read_query else None)
+
+        for short_code in self.archived_short_codes(tables_map):
+            archived = self.read_archived(short_code, start_date, end_date, ascending, limit=1)
+
+            if len(archived):
+                grouped.setdefault(short_code, []).extend(archived.to_ticks()[:1])
+                grouped[short_code].sort(key=lambda tick: tick.event_at, reverse=not ascending)
+
+        return {short_code: ticks[0] for short_code, ticks in grouped.items()}
+
+    def hot_tables_map(self, tables_map):
+        return {short_code: self.hot_tables(table_list) for short_code, table_list in tables_map.items()}
+
+    def archived_short_codes(self, tables_map):
+        return [short_code for short_code, table_list in tables_map.items()
+                if any(self.register.is_archived(table) for table in table_list)]
+
+    def group_ticks(self, response):
+        result = defaultdict(list)
+
+        for row in response or []:
+            result[row["short_code"]].append(Tick(**row))
+
+        return dict(result)
+
 
 class QueryBuilder:
-    def __init__(self):
-        pass
+    FIELDS = "event_at, current_value, current_volume"
 
-    def make_read_query(self, table_list, start_date, end_date, limit, ascending):
-        fields = "event_at, current_value, current_volume"
+    # fixed width, NOT NULL columns for binary decoding
+    ARRAY_FIELDS = ", ".join([
+        "event_at::timestamp AS event_at",
+        "COALESCE(current_value, 'NaN')::float8 AS current_value",
+        "COALESCE(current_volume, 0)::int8 AS current_volume",
+    ])
+
+    def __init__(self, storage_mode=STORAGE_MODE):
+        self.storage_mode = storage_mode
+
+    def make_read_query(self, table_list, start_date, end_date, limit, ascending, fields=None):
+        fields = self.FIELDS if not fields else fields
 
         select_queries = self.make_select_queries(
             table_list, fields, start_date, end_date)
@@ -95,7 +482,69 @@ class QueryBuilder:
 
         return read_query
 
+    def make_ohlc_query(self, table_list, start_date, end_date, bucket_seconds):
+        select_queries = self.make_select_queries(
+            table_list, self.FIELDS, start_date, end_date)
+
+        if not select_queries:
+            return None
+
+        return """
+            SELECT to_timestamp(floor(extract(epoch FROM {time_field}) / {bucket}) * {bucket})
+                       AT TIME ZONE 'UTC' AS bucket_at,
+                   (array_agg(current_value ORDER BY {time_field} ASC))[1] AS open_value,
+                   MAX(current_value) AS high_value,
+                   MIN(current_value) AS low_value,
+                   (array_agg(current_value ORDER BY {time_field} DESC))[1] AS close_value,
+                   SUM(current_volume) AS volume,
+                   COUNT(*) AS tick_count
+            FROM ({union_query}) AS ticks
+            GROUP BY 1
+            ORDER BY 1
+        """.format(time_field=TIME_FIELD, bucket=bucket_seconds, union_query=' UNION ALL '.join(select_queries))
+
+    def make_read_many_query(self, tables_map, start_date, end_date, ascending):
+        # every symbol is tagged with its short_code
+        select_queries = []
+
+        for short_code, table_list in tables_map.items():
+            select_queries.extend(self.make_select_queries(
+                table_list, self.make_tagged_fields(short_code), start_date, end_date))
+
+        if not select_queries:
+            return None
+
+        return ' UNION ALL '.join(select_queries) + " ORDER BY short_code, {time_field} {direction}".format(
+            time_field=TIME_FIELD,
+            direction="ASC" if ascending is True else "DESC")
+
+    def make_edge_many_query(self, tables_map, start_date, end_date, ascending):
+        # first / last tick of every symbol, each branch is a LIMIT 1 query
+        # which the planner answers from the event_at indexes
+        edge_queries = []
+
+        for index, (short_code, table_list) in enumerate(tables_map.items()):
+            read_query = self.make_read_query(table_list, start_date, end_date, 1, ascending)
+
+            if not read_query:
+                continue
+
+            edge_queries.append("SELECT {fields} FROM ({read_query}) AS edge_{index}".format(
+                fields=self.make_tagged_fields(short_code), read_query=read_query, index=index))
+
+        if not edge_queries:
+            return None
+
+        return ' UNION ALL '.join(edge_queries)
+
+    def make_tagged_fields(self, short_code):
+        return "'{short_code}' AS short_code, event_at, current_value, current_volume".format(
+            short_code=str(short_code).replace("'", "''"))
+
     def make_select_queries(self, table_list, fields, start_date, end_date):
+        if self.storage_mode == "native":
+            return self.make_parent_select_queries(table_list, fields, start_date, end_date)
+
         queries = []
 
         for table in table_list:
@@ -119,6 +568,17 @@ class QueryBuilder:
 
         return queries
 
+    def make_parent_select_queries(self, table_list, fields, start_date, end_date):
+        # one query against the partitioned parent, the planner prunes the partitions
+        parents = sorted(set(table.parent_full_name for table in table_list))
+
+        return ["""
+            SELECT {fields} FROM {parent_name}
+            WHERE {time_field} >= to_timestamp({start_date}) AND {time_field} <= to_timestamp({end_date})
+        """.format(fields=fields, parent_name=parent_name, time_field=TIME_FIELD,
+                   start_date=time_in_seconds(start_date), end_date=time_in_seconds(end_date))
+                for parent_name in parents]
+
     def make_union_queries(self, queries, ascending, limit):
         merge_query = ' UNION ALL '.join(queries)
 
@@ -1,16 +1,159 @@
-import datetime
+import time
 from collections import defaultdict
 
+import numpy as np
+
+from earth.base.archive import TickArchive
+from earth.base.catalog import PartitionCatalog
 from earth.base.database import Database
-from earth.base.register_models import DateRange, Label, Table
+from earth.base.partition_index import PartitionIndex
+from earth.base.register_models import DateRange, Label, Partition, Table
+from earth.base.symbols import SymbolRegistry
 from earth.exceptions import NotFound
+from earth.settings import DEFAULT_GRANULARITY, PARTITION_GRANULARITY, PARTITION_INTERVALS, PARTITION_MAX_ROWS, \
+    REGISTER_MISS_INTERVAL, REGISTER_TTL
 from earth.utils import Singleton
 
 
+def granularity_of(date_range):
+    # nearest one, local time ranges may differ from the interval by an hour
+    width = (date_range.finish - date_range.start).total_seconds()
+
+    return min(PARTITION_INTERVALS, key=lambda name: abs(PARTITION_INTERVALS[name].total_seconds() - width))
+
+
+def choose_granularity(row_count, span_seconds):
+    # coarsest granularity whose partitions stay under PARTITION_MAX_ROWS
+    if row_count <= 1 or span_seconds <= 0:
+        return DEFAULT_GRANULARITY
+
+    density = row_count / span_seconds
+    names = sorted(PARTITION_INTERVALS, key=lambda name: PARTITION_INTERVALS[name], reverse=True)
+
+    for name in names:
+        if density * PARTITION_INTERVALS[name].total_seconds() <= PARTITION_MAX_ROWS:
+            return name
+
+    return names[-1]
+
+
 class Register(metaclass=Singleton):
     def __init__(self):
         self.db = Database()
 
+        self.catalog = PartitionCatalog()
+        self.archive = TickArchive()
+
+        self.index = None
+        self.loaded_at = None
+        self.missed_at = None
+        self.granularities = {}
+
+        self.label_cache = {}
+        self.table_cache = {}
+
+    ###########################
+
+    # partition index
+
+    @property
+    def partition_index(self):
+        # kept up to date by add_table / remove_table, reloaded on a TTL
+        # for the partitions other processes write
+        if self.index is None or time.monotonic() - self.loaded_at > REGISTER_TTL:
+            self.refresh()
+
+        return self.index
+
+    def refresh(self):
+        # the catalog knows ranges and stats, tables missing from it
+        # get unknown stats and are never pruned
+        partitions = self.catalog.load(cached=False)
+        catalogued = set(partition.table.name for partition in partitions)
+
+        partitions += [Partition(table=Table.from_key(table_key)) for table_key in self.db.table_list(cached=False)
+                       if table_key not in catalogued]
+
+        self.index = PartitionIndex(partitions)
+        self.loaded_at = time.monotonic()
+
+    def refresh_on_miss(self):
+        """
+        Reloads the partitions and symbols after a lookup missed,
+        at most once per REGISTER_MISS_INTERVAL, True when reloaded
+        """
+        current_time = time.monotonic()
+
+        if self.missed_at is not None and current_time - self.missed_at < REGISTER_MISS_INTERVAL:
+            return False
+
+        self.missed_at = current_time
+
+        self.refresh()
+        SymbolRegistry().refresh()
+
+        return True
+
+    def add_table(self, table, partition=None):
+        return self.partition_index.add(table, partition)
+
+    def record_write(self, table, row_count, min_event_at, max_event_at, conn=None):
+        self.record_catalog(table, row_count, min_event_at, max_event_at, conn=conn)
+        self.record_stats(table, row_count, min_event_at, max_event_at)
+
+    def record_catalog(self, table, row_count, min_event_at, max_event_at, conn=None):
+        stats = self.partition_stats(table)
+
+        if stats is not None and stats.row_count is None:
+            # the batch bounds are not the bounds of an uncatalogued table
+            self.catalog.sync(table, conn=conn)
+        else:
+            self.catalog.record(table, row_count, min_event_at, max_event_at, conn=conn)
+
+    def record_stats(self, table, row_count, min_event_at, max_event_at):
+        # in memory only, after the catalog write is committed
+        self.partition_index.record(table, row_count, min_event_at, max_event_at)
+
+    def record_removal(self, table, row_count, conn=None):
+        self.catalog.remove_rows(table, row_count, conn=conn)
+        self.partition_index.remove_rows(table, row_count)
+
+    def partition_stats(self, table):
+        return self.partition_index.stats.get(table)
+
+    def dirty_tables(self):
+        """
+        {Table: dirty row count}, partitions written since the last maintenance run,
+        partitions without stats are dirty too
+        """
+        with self.partition_index.lock:
+            return {table: stats.dirty_rows for table, stats in self.partition_index.stats.items()
+                    if not stats.archived and (stats.row_count is None or stats.dirty_rows)}
+
+    def mark_clean(self, dirty):
+        self.catalog.clean(dirty)
+
+        with self.partition_index.lock:
+            for table, row_count in dirty.items():
+                stats = self.partition_stats(table)
+
+                if stats is not None:
+                    stats.dirty_rows = max(stats.dirty_rows - row_count, 0)
+
+    def remove_table(self, table):
+        return self.partition_index.remove(table)
+
+    def has_table(self, table):
+        return table in self.partition_index
+
+    def is_archived(self, table):
+        stats = self.partition_stats(table)
+        return stats is not None and stats.archived
+
+    def is_sealed(self, table):
+        stats = self.partition_stats(table)
+        return stats is not None and stats.sealed
+
     ###########################
 
     # unshaped collections
@@ -20,9 +163,7 @@ class Register(metaclass=Singleton):
         """
         [Table(label=Label, date_range=DateRange), ]
         """
-        table_keys = self.db.table_list()
-
-        return set([Table.from_key(table_key) for table_key in table_keys])
+        return set(self.partition_index.tables)
 
     @property
     def labels(self):
@@ -30,7 +171,7 @@ class Register(metaclass=Singleton):
         [Label(value), ]
         """
 
-        return set([table.label for table in self.tables])
+        return self.partition_index.labels()
 
     ###########################
 
@@ -56,59 +197,161 @@ class Register(metaclass=Singleton):
 
     # for reader
     def tables_by_short_code(self, short_code, start_date, end_date):
-        # FIXME
+        table_list = self.lookup(short_code, start_date, end_date)
 
-        # store for table names
-        table_name_list = []
+        if table_list is None:
+            raise NotFound(short_code, start_date, end_date)
 
-        # extract information
-        label = Label.from_key(short_code)
-        date_range = DateRange.make_from_ranges(start_date, end_date)
-        range_tables = self.label_range_tables_tree[label.machine_key]
+        return table_list
 
-        if not range_tables:
-            raise NotFound(short_code, start_date, end_date)
+    def tables_by_short_codes(self, short_codes, start_date, end_date):
+        """
+        {short_code: [Table, ]}, unknown symbols are left out
+        """
+        result = {}
+
+        for short_code in short_codes:
+            table_list = self.lookup(short_code, start_date, end_date)
+
+            if table_list is not None:
+                result[short_code] = table_list
+
+        return result
+
+    def lookup(self, short_code, start_date, end_date):
+        # another process may have created the label or its newer partitions
+        machine_key = Label.from_key(short_code).machine_key
+        table_list = self.partition_index.lookup(machine_key, start_date, end_date)
+
+        if self.is_missing(machine_key, table_list, end_date) and self.refresh_on_miss():
+            table_list = self.partition_index.lookup(machine_key, start_date, end_date)
 
-        # logic
-        for table_range in range_tables:
-            if date_range.overlaps(table_range):
-                table_name_list.append(range_tables[table_range])
+        return table_list
 
-        # response
-        return table_name_list
+    def is_missing(self, machine_key, table_list, end_date):
+        if table_list is None:
+            return True
+
+        last_table = self.partition_index.last_table(machine_key)
+
+        return last_table is not None and end_date is not None and end_date > last_table.date_range.finish
 
     # for writer
     def separate_ticks_to_tables(self, ticks):
-        # FIXME
+        """
+        {Table: [Tick, ]}, ticks are sorted by (short_code, event_at) and
+        deduplicated on that pair, every list is a contiguous slice
+        """
         tables = defaultdict(list)
+        ticks = list(ticks)
+
+        if not ticks:
+            return tables
+
+        # epoch microseconds, naive datetimes are utc like time_in_seconds
+        micros = np.array([tick.event_at for tick in ticks], dtype="datetime64[us]").astype(np.int64)
+        short_codes, code_ids = np.unique(
+            np.array([tick.short_code for tick in ticks], dtype=object), return_inverse=True)
+
+        order = np.lexsort((micros, code_ids))
+        micros, code_ids = micros[order], code_ids[order]
+
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = (code_ids[1:] != code_ids[:-1]) | (micros[1:] != micros[:-1])
+        order, micros, code_ids = order[keep], micros[keep], code_ids[keep]
+
+        sorted_ticks = [ticks[index] for index in order.tolist()]
+        seconds = micros // 1000000
+
+        # one slice per symbol, then one slice per bin inside it
+        code_bounds = np.flatnonzero(code_ids[1:] != code_ids[:-1]) + 1
+        code_starts = [0] + code_bounds.tolist()
+        code_ends = code_bounds.tolist() + [len(order)]
+
+        for code_start, code_end in zip(code_starts, code_ends):
+            label = self.label_of(short_codes[code_ids[code_start]])
+            span_seconds = int(seconds[code_end - 1] - seconds[code_start])
+            granularity = self.granularity(label, code_end - code_start, span_seconds)
+            interval_seconds = int(PARTITION_INTERVALS[granularity].total_seconds())
 
-        ticks = sorted(list(set(ticks)), key=lambda x: x.event_at)
+            bins = seconds[code_start:code_end] // interval_seconds
+            bin_bounds = (np.flatnonzero(bins[1:] != bins[:-1]) + 1).tolist()
 
-        for tick in ticks:
-            label = Label.from_value(value=tick.short_code)
-            date_range = DateRange.from_timestamp(
-                event_at=tick.event_at,
-                interval=datetime.timedelta(days=365)
-            )
+            for bin_start, bin_end in zip([0] + bin_bounds, bin_bounds + [len(bins)]):
+                table = self.table_of(label, int(bins[bin_start]), interval_seconds)
 
-            table = Table.from_value(label, date_range)
-            tables[table].append(tick)
+                # extend, short codes differing only in case share a label
+                tables[table].extend(sorted_ticks[code_start + bin_start:code_start + bin_end])
 
         return tables
 
+    def label_of(self, short_code):
+        label = self.label_cache.get(short_code)
+
+        if label is None:
+            label = self.label_cache[short_code] = Label.from_value(value=short_code)
+
+        return label
+
+    def table_of(self, label, current_bin, interval_seconds):
+        key = (label.machine_key, current_bin, interval_seconds)
+        table = self.table_cache.get(key)
+
+        if table is None:
+            date_range = DateRange.from_bin(current_bin, interval_seconds)
+            table = self.table_cache[key] = Table.from_value(label, date_range)
+
+        return table
+
+    ###########################
+
+    # partition granularity
+
+    def granularity(self, label, row_count=0, span_seconds=0):
+        """
+        Existing partitions keep their width until repartitioned,
+        new labels get the target granularity
+        """
+        last_table = self.partition_index.last_table(label.machine_key)
+
+        if last_table is not None:
+            return granularity_of(last_table.date_range)
+
+        return self.target_granularity(label, row_count, span_seconds)
+
+    def target_granularity(self, label, row_count=0, span_seconds=0):
+        name = self.granularities.get(label.machine_key) or PARTITION_GRANULARITY.get(label.machine_key)
+
+        if name:
+            return name
+
+        return choose_granularity(row_count, span_seconds)
+
+    def set_granularity(self, short_code, name):
+        if name not in PARTITION_INTERVALS:
+            raise ValueError("Unknown granularity: {}".format(name))
+
+        self.granularities[Label.from_key(short_code).machine_key] = name
+
     ###########################
 
-    def get_table_column(self, table, field_name):
-        if table in self.tables:
+    def metadata_by_labels(self, labels):
+        """
+        {machine_key: [symbol row]}, same shape as Label.metadata
+        """
+        return SymbolRegistry().metadata_many(label.machine_key for label in labels)
+
+    def get_table_column(self, table, field_name, conn=None):
+        if self.has_table(table):
             timestamps = self.db.run_query(
-                "SELECT {} FROM {}".format(field_name, table.full_name))
+                "SELECT {} FROM {}".format(field_name, table.full_name), conn=conn)
 
             return set([item[field_name] for item in timestamps])
 
         return set()
 
     def get_table_size(self, table):
-        if table in self.tables:
+        if self.has_table(table):
             result = self.db.run_query("SELECT COUNT(*) AS count_val FROM {}".format(table.full_name))
             return result[0]["count_val"]
 
@@ -1,7 +1,8 @@
+import datetime
+
 import attr
 
-from earth.base.database import Database
-from earth.settings import SCHEMA_NAME, SYMBOLS_TABLE
+from earth.settings import PARENT_TABLE_PREFIX, SCHEMA_NAME, TIME_FIELD
 from earth.utils import from_timestamp, generate_ranges, time_in_seconds
 
 
@@ -44,6 +45,78 @@ class Table:
     def full_name(self):
         return SCHEMA_NAME + "." + self.name
 
+    @property
+    def parent_name(self):
+        # PARTITION BY RANGE parent of the label in native storage mode
+        return PARENT_TABLE_PREFIX + self.label.machine_key
+
+    @property
+    def parent_full_name(self):
+        return SCHEMA_NAME + "." + self.parent_name
+
+    @property
+    def index_name(self):
+        return self.name + "_event_at_idx"
+
+    @property
+    def index_query(self):
+        return "CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {full_name} ({time_field} ASC)".format(
+            index_name=self.index_name, full_name=self.full_name, time_field=TIME_FIELD)
+
+    @property
+    def brin_index_name(self):
+        return self.name + "_event_at_brin"
+
+    @property
+    def brin_index_query(self):
+        return "CREATE INDEX IF NOT EXISTS {index_name} ON {full_name} USING brin ({time_field})".format(
+            index_name=self.brin_index_name, full_name=self.full_name, time_field=TIME_FIELD)
+
+    @property
+    def concurrent_index_query(self):
+        # does not block writes, has to run outside a transaction
+        return "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON {full_name} ({time_field} ASC)".format(
+            index_name=self.index_name, full_name=self.full_name, time_field=TIME_FIELD)
+
+
+@attr.s(slots=True)
+class Partition:
+    """
+    Stats of a partition, min / max are the actual event_at bounds,
+    row_count is None when the stats are unknown, archived ones are
+    stored in earth.archive instead of a table, dirty_rows are the rows
+    written since the last maintenance run, sealed ones are closed tables
+    made logged, clustered and uniquely indexed on event_at
+    """
+    table = attr.ib()
+    row_count = attr.ib(default=None)
+    min_event_at = attr.ib(default=None)
+    max_event_at = attr.ib(default=None)
+    archived = attr.ib(default=False)
+    dirty_rows = attr.ib(default=0)
+    sealed = attr.ib(default=False)
+
+    def record(self, row_count, min_event_at, max_event_at):
+        if self.row_count is not None:
+            self.row_count += row_count
+
+        self.dirty_rows += row_count
+
+        if min_event_at is not None:
+            self.min_event_at = min_event_at if self.min_event_at is None else min(self.min_event_at, min_event_at)
+
+        if max_event_at is not None:
+            self.max_event_at = max_event_at if self.max_event_at is None else max(self.max_event_at, max_event_at)
+
+    def intersects(self, start_date, end_date):
+        if self.row_count is None:
+            return True
+
+        if not self.row_count or self.min_event_at is None:
+            return False
+
+        return self.min_event_at <= end_date and start_date <= self.max_event_at
+
 
 @attr.s(slots=True, frozen=True)
 class Label:
@@ -78,14 +151,9 @@ class Label:
 
     @property
     def metadata(self):
-        table_full = SCHEMA_NAME + "." + SYMBOLS_TABLE
+        from earth.base.symbols import SymbolRegistry
 
-        return Database().run_query("""
-            SELECT * 
-            FROM {table_full} 
-            WHERE LOWER(short_code) = '{label}' 
-            LIMIT 1
-        """.format(table_full=table_full, label=self.machine_key))
+        return SymbolRegistry().metadata_many([self.machine_key]).get(self.machine_key, [])
 
 
 @attr.s(slots=True, frozen=True)
@@ -108,6 +176,15 @@ class DateRange:
 
         return cls.from_values(machine_key, ranges["start"], ranges["finish"])
 
+    @classmethod
+    def from_bin(cls, current_bin, interval_seconds):
+        ranges = dict(
+            start=from_timestamp(current_bin * interval_seconds),
+            finish=from_timestamp((current_bin + 1) * interval_seconds)
+        )
+
+        return cls.from_values(cls.make_key(ranges), ranges["start"], ranges["finish"])
+
     @classmethod
     def make_key(cls, ranges):
         return "{start}{sep}{finish}".format(
@@ -137,8 +214,18 @@ class DateRange:
             finish=finish_dt
         )
 
+    @property
+    def utc_start(self):
+        # ticks are binned by their seconds since epoch, these are the bin bounds
+        return datetime.datetime.utcfromtimestamp(self.start.timestamp())
+
+    @property
+    def utc_finish(self):
+        return datetime.datetime.utcfromtimestamp(self.finish.timestamp())
+
     def overlaps(self, table_range):
-        if self.contains(table_range.start) or self.contains(table_range.finish):
+        # also true when one range sits inside the other
+        if self.start <= table_range.finish and table_range.start <= self.finish:
             return True
 
         return False
@@ -0,0 +1,182 @@
+import datetime
+
+from earth.base.database import Database
+from earth.base.io_models import Candle
+from earth.base.register import Register
+from earth.base.register_models import Label
+from earth.settings import ROLLUP_RESOLUTIONS, ROLLUP_TABLE_PREFIX, SCHEMA_NAME, STORAGE_MODE, TIME_FIELD
+from earth.utils import interval_in_seconds, time_in_seconds
+
+# same bucketing as QueryBuilder.make_ohlc_query
+BUCKET_EXPRESSION = "to_timestamp(floor(extract(epoch FROM {field}) / {seconds}) * {seconds}) AT TIME ZONE 'UTC'"
+
+CANDLE_FIELDS = ["open_value", "high_value", "low_value", "close_value", "volume", "tick_count"]
+
+
+class Rollups:
+    """
+    earth.rollup_<resolution> tables, one OHLC row per (short_code, bucket_at).
+    A write rebuilds only the buckets it touched: the finest resolution from
+    the raw ticks, coarser ones from the finest rollup that divides them.
+    """
+
+    def __init__(self, resolutions=ROLLUP_RESOLUTIONS, storage_mode=STORAGE_MODE):
+        self.db = Database()
+        self.register = Register()
+
+        self.resolutions = sorted(resolutions, key=interval_in_seconds)
+        self.storage_mode = storage_mode
+
+        self.created = False
+
+    def full_table_name(self, resolution):
+        return SCHEMA_NAME + "." + ROLLUP_TABLE_PREFIX + resolution
+
+    def create_tables(self):
+        if self.created:
+            return
+
+        self.db.run_multiple_queries(["""
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                short_code text NOT NULL,
+                bucket_at timestamp NOT NULL,
+                open_value float8,
+                high_value float8,
+                low_value float8,
+                close_value float8,
+                volume bigint,
+                tick_count bigint NOT NULL,
+                PRIMARY KEY (short_code, bucket_at)
+            )
+        """.format(table_name=self.full_table_name(resolution)) for resolution in self.resolutions])
+
+        self.created = True
+
+    ###########################
+
+    def source_resolution(self, resolution):
+        # finest rollups come from the raw ticks
+        seconds = interval_in_seconds(resolution)
+        finer = [item for item in self.resolutions
+                 if interval_in_seconds(item) < seconds and seconds % interval_in_seconds(item) == 0]
+
+        return finer[-1] if finer else None
+
+    def choose(self, bucket_seconds):
+        """
+        Coarsest resolution whose buckets add up to bucket_seconds, None when no rollup fits
+        """
+        fitting = [resolution for resolution in self.resolutions if bucket_seconds % interval_in_seconds(resolution) == 0]
+
+        return fitting[-1] if fitting else None
+
+    ###########################
+
+    def update(self, label, min_event_at, max_event_at, conn=None):
+        """
+        Rebuilds the buckets of every resolution that hold [min_event_at, max_event_at]
+        """
+        if not self.resolutions:
+            return
+
+        self.create_tables()
+
+        queries = [self.update_query(label, resolution, min_event_at, max_event_at)
+                   for resolution in self.resolutions]
+        queries = [query for query in queries if query]
+
+        if queries:
+            self.db.run_multiple_queries(queries, conn=conn)
+
+    def update_query(self, label, resolution, min_event_at, max_event_at):
+        seconds = interval_in_seconds(resolution)
+
+        start = datetime.datetime.utcfromtimestamp(time_in_seconds(min_event_at) // seconds * seconds)
+        finish = datetime.datetime.utcfromtimestamp((time_in_seconds(max_event_at) // seconds + 1) * seconds)
+
+        source = self.source_resolution(resolution)
+
+        if source is not None:
+            select_query = """
+                SELECT short_code, {bucket} AS bucket_at,
+                       (array_agg(open_value ORDER BY bucket_at ASC))[1],
+                       MAX(high_value), MIN(low_value),
+                       (array_agg(close_value ORDER BY bucket_at DESC))[1],
+                       SUM(volume), SUM(tick_count)
+                FROM {source_name}
+                WHERE short_code = '{short_code}' AND bucket_at >= '{start}' AND bucket_at < '{finish}'
+                GROUP BY 1, 2
+            """.format(bucket=BUCKET_EXPRESSION.format(field="bucket_at", seconds=seconds),
+                       source_name=self.full_table_name(source), short_code=label.machine_key,
+                       start=start, finish=finish)
+        else:
+            raw_queries = self.raw_queries(label, start, finish)
+
+            if not raw_queries:
+                return None
+
+            select_query = """
+                SELECT '{short_code}', {bucket} AS bucket_at,
+                       (array_agg(current_value ORDER BY {time_field} ASC))[1],
+                       MAX(current_value), MIN(current_value),
+                       (array_agg(current_value ORDER BY {time_field} DESC))[1],
+                       SUM(current_volume), COUNT(*)
+                FROM ({union_query}) AS ticks
+                GROUP BY 1, 2
+            """.format(short_code=label.machine_key, bucket=BUCKET_EXPRESSION.format(field=TIME_FIELD, seconds=seconds),
+                       time_field=TIME_FIELD, union_query=" UNION ALL ".join(raw_queries))
+
+        return """
+            INSERT INTO {table_name} (short_code, bucket_at, {fields})
+            {select_query}
+            ON CONFLICT (short_code, bucket_at) DO UPDATE SET {updates}
+        """.format(table_name=self.full_table_name(resolution), fields=", ".join(CANDLE_FIELDS),
+                   select_query=select_query,
+                   updates=", ".join("{0} = EXCLUDED.{0}".format(field) for field in CANDLE_FIELDS))
+
+    def raw_queries(self, label, start, finish):
+        # by range only, the stats of a partition written in the current
+        # transaction are not recorded yet and lookup would prune it.
+        # archived partitions are closed, their buckets were built before archiving
+        tables = [table for table in self.register.partition_index.label_tables(label.machine_key)
+                  if table.date_range.utc_start < finish and start < table.date_range.utc_finish
+                  and not self.register.is_archived(table)]
+
+        if self.storage_mode == "native":
+            names = sorted(set(table.parent_full_name for table in tables))
+        else:
+            names = [table.full_name for table in tables]
+
+        return ["""
+            SELECT {time_field}, current_value, current_volume FROM {table_name}
+            WHERE {time_field} >= '{start}' AND {time_field} < '{finish}'
+        """.format(time_field=TIME_FIELD, table_name=name, start=start, finish=finish) for name in names]
+
+    ###########################
+
+    def read(self, short_code, resolution, start_date, end_date, bucket_seconds):
+        """
+        [Candle, ] of bucket_seconds aggregated from the rollup buckets starting
+        in [start_date, end_date), Reader.read_rollup_ohlc adds the partial edges
+        """
+        if bucket_seconds % interval_in_seconds(resolution) != 0:
+            raise ValueError("Resolution {} does not divide {} seconds".format(resolution, bucket_seconds))
+
+        self.create_tables()
+
+        response = self.db.run_query("""
+            SELECT {bucket} AS bucket_at,
+                   (array_agg(open_value ORDER BY bucket_at ASC))[1] AS open_value,
+                   MAX(high_value) AS high_value,
+                   MIN(low_value) AS low_value,
+                   (array_agg(close_value ORDER BY bucket_at DESC))[1] AS close_value,
+                   SUM(volume)::int8 AS volume,
+                   SUM(tick_count)::int8 AS tick_count
+            FROM {table_name}
+            WHERE short_code = %s AND bucket_at >= %s AND bucket_at < %s
+            GROUP BY 1
+            ORDER BY 1
+        """.format(bucket=BUCKET_EXPRESSION.format(field="bucket_at", seconds=bucket_seconds),
+                   table_name=self.full_table_name(resolution)), (Label.make_key(short_code), start_date, end_date))
+
+        return [Candle(short_code=short_code, **row) for row in response or []]
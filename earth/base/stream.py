@@ -0,0 +1,175 @@
+import asyncio
+import atexit
+import threading
+import time
+
+from earth.base.writer import Writer
+from earth.settings import STREAM_MAX_DELAY, STREAM_MAX_PENDING, STREAM_MAX_SIZE
+
+
+class StreamWriter:
+    """
+    Accepts single ticks from many threads or asyncio tasks and writes them
+    in batches through Writer.write_ticks, which splits them per partition.
+    A batch is flushed when max_size ticks are buffered or the oldest one
+    waited max_delay seconds, the buffer is flushed on close and at exit.
+    Failed background flushes are raised by the next put, flush or close.
+    """
+
+    def __init__(self, writer=None, max_size=STREAM_MAX_SIZE, max_delay=STREAM_MAX_DELAY,
+                 max_pending=STREAM_MAX_PENDING):
+        self.writer = writer if writer is not None else Writer(progress=False)
+
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+
+        self.buffer = []
+        self.first_at = None
+        self.closed = False
+        self.errors = []
+
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._run, name="earth-stream-writer", daemon=True)
+        self.thread.start()
+
+        atexit.register(self.close)
+
+    ###########################
+
+    # producers
+
+    def put(self, tick):
+        self.put_many([tick])
+
+    def put_many(self, ticks):
+        self._raise_errors()
+
+        with self.condition:
+            for tick in ticks:
+                # backpressure, wait for the flusher to make room
+                while len(self.buffer) >= self.max_pending and not self.closed:
+                    self.condition.wait()
+
+                if self.closed:
+                    raise RuntimeError("StreamWriter is closed")
+
+                if not self.buffer:
+                    # the flusher waits without a timeout while the buffer is empty
+                    self.first_at = time.monotonic()
+                    self.condition.notify_all()
+
+                self.buffer.append(tick)
+
+            if len(self.buffer) >= self.max_size:
+                self.condition.notify_all()
+
+    async def aput(self, tick):
+        # only a full buffer blocks, that wait happens off the event loop
+        if len(self.buffer) < self.max_pending:
+            return self.put(tick)
+
+        await asyncio.get_running_loop().run_in_executor(None, self.put, tick)
+
+    ###########################
+
+    def flush(self):
+        with self.condition:
+            batch = self._take(everything=True)
+
+        self._raise_errors()
+
+        return self._write(batch, raise_errors=True)
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+
+            self.closed = True
+            self.condition.notify_all()
+
+        # the flusher drains the buffer before it stops
+        self.thread.join()
+
+        atexit.unregister(self.close)
+
+        self._raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    ###########################
+
+    # flusher
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.closed and not self._due():
+                    self.condition.wait(self._remaining())
+
+                if self.closed and not self.buffer:
+                    return
+
+                batch = self._take(everything=self.closed)
+
+            self._write(batch)
+
+    def _due(self):
+        if not self.buffer:
+            return False
+
+        return len(self.buffer) >= self.max_size or time.monotonic() - self.first_at >= self.max_delay
+
+    def _remaining(self):
+        if not self.buffer:
+            return None
+
+        return max(self.max_delay - (time.monotonic() - self.first_at), 0)
+
+    def _take(self, everything=False):
+        batch = self.buffer if everything else self.buffer[:self.max_size]
+        self.buffer = self.buffer[len(batch):]
+        self.first_at = time.monotonic() if self.buffer else None
+
+        self.condition.notify_all()
+
+        return batch
+
+    def _write(self, batch, raise_errors=False):
+        if not batch:
+            return None
+
+        # one batch at a time, keeps the order of the ticks per partition
+        with self.write_lock:
+            try:
+                return self.writer.write_ticks(batch)
+            except Exception as exc:
+                if raise_errors:
+                    raise
+
+                with self.condition:
+                    self.errors.append(exc)
+
+    def _raise_errors(self):
+        with self.condition:
+            errors, self.errors = self.errors, []
+
+        if len(errors) == 1:
+            raise errors[0]
+
+        if errors:
+            raise RuntimeError("{} background writes failed: {}".format(
+                len(errors), "; ".join(str(exc) for exc in errors))) from errors[0]
@@ -0,0 +1,131 @@
+import threading
+import time
+
+import attr
+
+from earth.base.database import Database
+from earth.base.io_models import Symbol
+from earth.base.register_models import Label
+from earth.settings import REGISTER_TTL, SCHEMA_NAME, SYMBOLS_TABLE
+from earth.utils import Singleton
+
+SYMBOL_FIELDS = [field.name for field in attr.fields(Symbol)]
+
+
+class SymbolRegistry(metaclass=Singleton):
+    """
+    Symbol metadata of earth.symbols, loaded with a single query
+    and kept in memory by machine key, reloaded every REGISTER_TTL seconds
+    """
+
+    def __init__(self):
+        self.db = Database()
+
+        self.symbols = None
+        self.loaded_at = None
+        self.lock = threading.RLock()
+
+    @property
+    def full_table_name(self):
+        return SCHEMA_NAME + "." + SYMBOLS_TABLE
+
+    ###########################
+
+    def load(self):
+        with self.lock:
+            self.create_table()
+
+            response = self.db.run_query("SELECT {fields} FROM {table_name}".format(
+                fields=", ".join(SYMBOL_FIELDS), table_name=self.full_table_name), cached=False)
+
+            self.symbols = {Label.make_key(row["short_code"]): Symbol(**row) for row in response or []}
+            self.loaded_at = time.monotonic()
+
+    def is_expired(self):
+        return self.symbols is None or time.monotonic() - self.loaded_at > REGISTER_TTL
+
+    def create_table(self):
+        # the unique index also covers tables created before the primary key
+        table_name = self.full_table_name
+        index_name = SYMBOLS_TABLE + "_short_code_idx"
+
+        self.db.run_multiple_queries(["""
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                full_name text,
+                short_code text PRIMARY KEY,
+                available_count int8,
+                category text,
+                icon_url text,
+                currency text
+            )
+        """.format(table_name=table_name), """
+            CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {table_name} (short_code)
+        """.format(index_name=index_name, table_name=table_name)])
+
+    def refresh(self):
+        with self.lock:
+            self.symbols = None
+
+    ###########################
+
+    def get(self, short_code):
+        with self.lock:
+            if self.is_expired():
+                self.load()
+
+            return self.symbols.get(Label.make_key(short_code))
+
+    def all(self):
+        with self.lock:
+            if self.is_expired():
+                self.load()
+
+            return list(self.symbols.values())
+
+    def metadata_many(self, short_codes):
+        """
+        {machine_key: [symbol row]}, unknown symbols are left out
+        """
+        result = {}
+
+        for short_code in short_codes:
+            symbol = self.get(short_code)
+
+            if symbol is not None:
+                result[Label.make_key(short_code)] = [symbol.as_dict()]
+
+        return result
+
+    ###########################
+
+    def upsert(self, symbols):
+        """
+        Saves new and changed symbols with one INSERT ... ON CONFLICT DO UPDATE,
+        returns the symbols that were written
+        """
+        # last record of a short_code wins, a statement can not update a row twice
+        incoming = {}
+
+        for symbol in symbols:
+            incoming[Label.make_key(symbol.short_code)] = symbol
+
+        with self.lock:
+            if self.is_expired():
+                self.load()
+
+            changed = [symbol for key, symbol in incoming.items() if self.symbols.get(key) != symbol]
+
+            if changed:
+                self.save(changed)
+
+                for symbol in changed:
+                    self.symbols[Label.make_key(symbol.short_code)] = symbol
+
+        return changed
+
+    def save(self, symbols):
+        rows = [tuple(getattr(symbol, field) for field in SYMBOL_FIELDS) for symbol in symbols]
+        updates = ", ".join("{0} = EXCLUDED.{0}".format(field) for field in SYMBOL_FIELDS if field != "short_code")
+
+        self.db.insert_rows(self.full_table_name, SYMBOL_FIELDS, rows, conflict_field="short_code",
+                            conflict_action="DO UPDATE SET " + updates)
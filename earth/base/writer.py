@@ -1,19 +1,47 @@
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import psycopg2
 from tqdm import tqdm
 
 import venus
 from earth.base.database import Database
+from earth.base.dedup import Deduplicator
+from earth.base.encoding import encode_binary, encode_csv
+from earth.base.io_models import TickFrame
+from earth.base.latest import LatestTicks
 from earth.base.register import Register
-from earth.settings import SCHEMA_NAME, SYMBOLS_TABLE, TIME_FIELD
+from earth.base.rollup import Rollups
+from earth.base.symbols import SymbolRegistry
+from earth.settings import COPY_BATCH_SIZE, COPY_FORMAT, DEDUP_MODE, INGEST_MODE, STORAGE_MODE, TICK_COLUMNS, \
+    TIME_FIELD, WRITE_WORKERS
+from earth.exceptions import WriteError
+from earth.utils import chunks
 
 
 class Writer:
-    def __init__(self):
+    def __init__(self, ingest_mode=INGEST_MODE, copy_format=COPY_FORMAT, copy_batch_size=COPY_BATCH_SIZE,
+                 dedup_mode=DEDUP_MODE, storage_mode=STORAGE_MODE, workers=WRITE_WORKERS, progress=True):
         self.db = Database()
         self.register = Register()
+        self.latest = LatestTicks()
+        self.symbols = SymbolRegistry()
+        self.rollups = Rollups(storage_mode=storage_mode)
         self.qb = venus.qb
 
+        self.ingest_mode = ingest_mode
+        self.copy_format = copy_format
+        self.copy_batch_size = copy_batch_size
+        self.dedup_mode = dedup_mode
+        self.storage_mode = storage_mode
+        self.workers = workers
+        self.progress = progress
+
+        self.indexed_tables = set()
+        self.parent_tables = set()
+        self.lock = threading.Lock()
+
     def write(self, symbol, ticks):
         self.write_symbol(symbol)
 
@@ -23,121 +51,310 @@ class Writer:
 
     # database api
 
-    def write_ticks(self, ticks):
+    def write_ticks(self, ticks, workers=None):
         tables_map = self.register.separate_ticks_to_tables(ticks)
 
-        self.write_tables(tables_map, single=True)
+        stats = self.write_tables(tables_map, workers=workers)
+        failed = set(table for table, _ in stats["failures"])
+
+        # keep the latest value cache in step with the partitions
+        self.latest.update(tick for table, content in tables_map.items() if table not in failed
+                           for tick in content if self.valid_symbol(tick.short_code))
+
+        if failed:
+            raise WriteError(stats["failures"], stats)
+
+        return stats
+
+    def write_tables(self, tables, workers=None):
+        """
+        Every partition is written in its own transaction, by up to
+        `workers` threads. Returns ingest stats:
+        {"rows", "seconds", "rows_per_sec", "failures": [(Table, exception), ]}
+        """
+        workers = self.workers if workers is None else workers
+
+        # shared tables are created up front, so that a worker
+        # never needs a second connection while holding one
+        self.register.catalog.create_table()
+        self.rollups.create_tables()
 
-    def write_tables(self, tables, single=False):
-        if single:
-            for table, content in tqdm(tables.items(), desc="write"):
-                self.save_content(table, content)
+        if self.storage_mode == "native":
+            for table in tables:
+                self.create_parent_table(table)
+
+        row_count = 0
+        failures = []
+        started_at = time.perf_counter()
+
+        if workers <= 1:
+            progress = tqdm(tables.items(), desc="write", disable=not self.progress)
+
+            for table, content in progress:
+                try:
+                    row_count += self.write_partition(table, content)
+                except Exception as exc:
+                    failures.append((table, exc))
+
+                progress.set_postfix(rows_per_sec=int(self._rate(row_count, started_at)))
         else:
-            with ThreadPoolExecutor(max_workers=8) as pool:
-                # generate payload
-                future_to_url = {
-                    pool.submit(self.save_content, table_name, content): table_name
-                    for table_name, content in tables.items()
+            # the connection pool bounds the work in flight,
+            # Database.getconn blocks while every connection is taken
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                future_to_table = {
+                    pool.submit(self.write_partition, table, content): table
+                    for table, content in tables.items()
                 }
 
-                # start async jobs
-                for future in tqdm(as_completed(future_to_url), total=len(tables), desc="write"):
+                progress = tqdm(as_completed(future_to_table), total=len(tables), desc="write",
+                                disable=not self.progress)
+
+                for future in progress:
                     try:
-                        future.result()
+                        row_count += future.result()
                     except Exception as exc:
-                        table_name = future_to_url[future]
-                        print('%r generated an exception: %s' % (table_name, exc))
+                        failures.append((future_to_table[future], exc))
 
-    def write_symbol(self, new_symbol):
-        # determines insert or update
+                    progress.set_postfix(rows_per_sec=int(self._rate(row_count, started_at)))
 
-        old_symbol = self.register.labels.get(new_symbol.short_code)
+        return dict(
+            rows=row_count,
+            seconds=time.perf_counter() - started_at,
+            rows_per_sec=self._rate(row_count, started_at),
+            failures=failures,
+        )
 
-        if old_symbol is not None:
-            # update already saved symbol
-            self.update_symbol(old_symbol, new_symbol)
-        else:
-            # create metadata table if not exists
-            if len(self.register.labels) == 0:
-                self.create_metadata_table(old_symbol)
+    def write_partition(self, table, content):
+        existed = self.register.has_table(table)
+        archived = self.register.partition_stats(table) if self.register.is_archived(table) else None
+
+        try:
+            with self.db.transaction() as conn:
+                if archived is not None:
+                    content = self.restore_archived(table, conn=conn) + list(content)
 
-            # insert new symbol
-            self.insert_symbol(new_symbol)
+                row_count, min_event_at, max_event_at = self.save_content(table, content, conn=conn)
+        except Exception:
+            # an index built inside the rolled back transaction is gone too
+            self.indexed_tables.discard(table)
+
+            # the table was registered inside the rolled back transaction
+            if not existed or archived is not None:
+                self.register.remove_table(table)
+
+            if archived is not None:
+                self.register.add_table(table, archived)
+
+            raise
+
+        if row_count:
+            self.register.record_stats(table, row_count, min_event_at, max_event_at)
+
+        # drop what other threads cached before the commit,
+        # the catalog and rollup rows were written in the same transaction
+        self.db.invalidate(table.full_name)
+        self.db.invalidate(self.register.catalog.full_table_name)
+
+        for resolution in self.rollups.resolutions:
+            self.db.invalidate(self.rollups.full_table_name(resolution))
+
+        if self.storage_mode == "native":
+            # reads go through the parent
+            self.db.invalidate(table.parent_full_name)
+
+        return row_count
+
+    def _rate(self, row_count, started_at):
+        elapsed = time.perf_counter() - started_at
+        return row_count / elapsed if elapsed > 0 else 0.0
+
+    def write_symbol(self, symbol):
+        return self.write_symbols([symbol])
+
+    def write_symbols(self, symbols):
+        # new and changed symbols only, in one statement
+        return self.symbols.upsert(symbols)
 
     #####################################################################
 
     # save ticks
 
-    def save_content(self, table, content):
-        valid_content = self.clean_content(table, content)
+    def save_content(self, table, content, conn=None):
+        """
+        Returns (row count, min event_at, max event_at) of the saved ticks,
+        the in memory stats are left to the caller once committed
+        """
+        valid_content = self.clean_content(table, content, conn=conn)
 
         if not valid_content:
-            return None
+            return 0, None, None
+
+        self.create_tick_table(table, conn=conn)
+
+        row_count = self.insert_ticks_to_table(table, valid_content, conn=conn)
+
+        # every row of the batch is stored now, so its bounds are safe ones
+        timestamps = [item[TIME_FIELD] for item in valid_content]
+        min_event_at, max_event_at = min(timestamps), max(timestamps)
 
-        self.create_tick_table(table, valid_content)
-        self.insert_ticks_to_table(table, valid_content)
+        self.register.record_catalog(table, row_count, min_event_at, max_event_at, conn=conn)
 
-    def clean_content(self, table, content):
+        # only the buckets of this batch are rebuilt
+        self.rollups.update(table.label, min_event_at, max_event_at, conn=conn)
+
+        return row_count, min_event_at, max_event_at
+
+    def restore_archived(self, table, conn=None):
+        """
+        Late ticks for an archived partition, its chunks are turned back
+        into ticks that are written together with the new ones
+        """
+        event_at, current_value, current_volume = self.register.archive.read(table, conn=conn)
+
+        self.db.run_query(self.register.archive.remove_query([table]), conn=conn)
+        self.db.run_query(self.register.catalog.remove_query([table]), conn=conn)
+
+        # the table is created again by create_tick_table
+        self.register.remove_table(table)
+
+        return TickFrame(
+            short_code=table.label.value,
+            event_at=event_at,
+            current_value=current_value,
+            current_volume=current_volume).to_ticks()
+
+    def clean_content(self, table, content, conn=None):
         result = []
 
-        timestamps = self.register.get_table_column(table, TIME_FIELD)
+        # in conflict mode stored rows are skipped by the unique index,
+        # only the duplicates inside the batch are filtered here
+        if self.skips_conflicts(table):
+            timestamps = set()
+        else:
+            timestamps = self.register.get_table_column(table, TIME_FIELD, conn=conn)
 
         for item in content:
             not_saved = item.event_at not in timestamps
-            symbol_valid = item.short_code.isalnum() and not item.short_code[0].isdigit()
+            symbol_valid = self.valid_symbol(item.short_code)
 
             if not_saved and symbol_valid:
                 valid_item = item.as_dict()
                 result.append(valid_item)
+                timestamps.add(item.event_at)
 
         return result
 
-    def create_tick_table(self, table, sample):
-        if table not in self.register.tables:
-            create_table_query = self.qb.dict_to_create_table_query(table.full_name, sample)
-            self.db.run_query(create_table_query)
+    def skips_conflicts(self, table):
+        # sealed partitions always have the unique index, their ticks are not fetched
+        return self.dedup_mode == "conflict" or self.register.is_sealed(table)
 
-            disable_wal_query = "ALTER TABLE {} SET UNLOGGED".format(table.full_name)
-            self.db.run_query(disable_wal_query)
+    def valid_symbol(self, short_code):
+        return short_code.isalnum() and not short_code[0].isdigit()
 
-    def insert_ticks_to_table(self, table, content):
-        insert_data_query = self.qb.dict_to_insert_multiple_query(table.full_name, content)
-        self.db.run_query(insert_data_query, [tuple(x.values()) for x in content])
+    def create_tick_table(self, table, conn=None):
+        if self.storage_mode == "native":
+            return self.create_tick_partition(table, conn=conn)
 
-    #####################################################################
+        if not self.register.has_table(table):
+            # the column types binary COPY writes, unlogged only when
+            # created here, existing and sealed tables stay as they are
+            self.db.run_query("CREATE UNLOGGED TABLE IF NOT EXISTS {table_name} ({columns})".format(
+                table_name=table.full_name, columns=self.tick_columns()), conn=conn)
+
+            # new partition, table_list must see it
+            self.db.invalidate(table.full_name, created=True)
+            self.register.add_table(table)
+
+        if self.dedup_mode == "conflict":
+            self.create_unique_index(table, conn=conn)
+
+    def create_tick_partition(self, table, conn=None):
+        # partition of the label's PARTITION BY RANGE parent, created on demand
+        if self.register.has_table(table):
+            return
+
+        self.create_parent_table(table)
+
+        self.db.run_query("""
+            CREATE TABLE IF NOT EXISTS {table_name} PARTITION OF {parent_name}
+            FOR VALUES FROM ('{start}') TO ('{finish}')
+        """.format(table_name=table.full_name, parent_name=table.parent_full_name,
+                   start=table.date_range.utc_start, finish=table.date_range.utc_finish), conn=conn)
 
-    # save symbol
+        self.db.invalidate(table.full_name, created=True)
+        self.register.add_table(table)
+        self.indexed_tables.add(table)
 
-    def update_symbol(self, old_symbol, new_symbol):
-        short_code = old_symbol.short_code
+    def create_parent_table(self, table):
+        # committed on its own connection before the partitions are written,
+        # parallel workers all need to see it
+        parent_name = table.parent_full_name
 
-        new_fields = {
-            old_field: new_symbol[new_field]
-            for old_field, new_field
-            in zip(old_symbol.as_dict(), new_symbol.as_dict())
-            if old_symbol[old_field] != new_symbol[new_field]
-        }
+        with self.lock:
+            if parent_name in self.parent_tables:
+                return
 
-        sets = ["{} = {}".format(name, value) for name, value in new_fields.items()]
-        set_stmt = " ".join(sets)
+            self.db.run_query("CREATE TABLE IF NOT EXISTS {parent_name} ({columns}) PARTITION BY RANGE ({time_field})".format(
+                parent_name=parent_name, columns=self.tick_columns(), time_field=TIME_FIELD))
 
-        self.db.run_query("UPDATE earth.symbols SET {set_stmt} WHERE short_code = {short_code}".format(
-            set_stmt=set_stmt,
-            short_code=short_code
-        ))
+            # created on every partition as <partition>_event_at_idx
+            self.db.run_query("CREATE UNIQUE INDEX IF NOT EXISTS {name}_{time_field}_idx ON {parent_name} ({time_field})".format(
+                name=table.parent_name, parent_name=parent_name, time_field=TIME_FIELD))
+
+            self.parent_tables.add(parent_name)
+
+    def tick_columns(self):
+        return ", ".join("{} {}{}".format(name, pg_type, " NOT NULL" if name == TIME_FIELD else "")
+                         for name, pg_type in TICK_COLUMNS.items())
+
+    def create_unique_index(self, table, conn=None):
+        # ON CONFLICT needs the unique event_at index, duplicates
+        # stored before it existed are removed when it can not be built
+        if table in self.indexed_tables:
+            return
+
+        with self.db.transaction(conn) as active_conn:
+            self.db.run_query("SAVEPOINT unique_index", conn=active_conn)
+
+            try:
+                self.db.run_query(table.index_query, conn=active_conn)
+            except psycopg2.IntegrityError:
+                self.db.run_query("ROLLBACK TO SAVEPOINT unique_index", conn=active_conn)
+
+                result = Deduplicator(self.db).remove(table.full_name, conn=active_conn)
+                self.register.catalog.remove_rows(table, result["removed"], conn=active_conn)
+
+                self.db.run_query(table.index_query, conn=active_conn)
+
+        self.indexed_tables.add(table)
+
+    def insert_ticks_to_table(self, table, content, conn=None):
+        # returns the number of inserted rows
+        if self.ingest_mode == "copy":
+            return self.copy_ticks_to_table(table, content, conn=conn)
+
+        if self.skips_conflicts(table):
+            columns = list(content[0].keys())
+            rows = [tuple(x.values()) for x in content]
+
+            return self.db.insert_rows(table.full_name, columns, rows, conflict_field=TIME_FIELD, conn=conn)
+
+        insert_data_query = self.qb.dict_to_insert_multiple_query(table.full_name, content)
+        self.db.run_query(insert_data_query, [tuple(x.values()) for x in content], conn=conn)
 
-    def insert_symbol(self, symbol):
-        # make metadata
-        metadata = symbol.as_dict()
+        return len(content)
 
-        # save new metadata
-        table_full_name = SCHEMA_NAME + "." + SYMBOLS_TABLE
+    def copy_ticks_to_table(self, table, content, conn=None):
+        # streams the ticks with COPY FROM STDIN, one buffer per batch
+        columns = list(content[0].keys())
+        encoder = encode_binary if self.copy_format == "binary" else encode_csv
+        conflict_field = TIME_FIELD if self.skips_conflicts(table) else None
 
-        insert_data_query = self.qb.dict_to_insert_query(table_full_name, metadata)
-        return self.db.run_query(insert_data_query, [tuple(x.values()) for x in metadata])
+        row_count = 0
 
-    def create_metadata_table(self, sample):
-        table_full_name = SCHEMA_NAME + "." + SYMBOLS_TABLE
+        for batch in chunks(content, self.copy_batch_size):
+            buffer = encoder(batch, columns)
+            row_count += self.db.copy_from(
+                table.full_name, columns, buffer, fmt=self.copy_format, conflict_field=conflict_field, conn=conn)
 
-        create_table_query = self.qb.dict_to_create_table_query(table_full_name, sample)
-        self.db.run_query(create_table_query)
+        return row_count
@@ -1,2 +1,15 @@
 class NotFound(Exception):
     pass
+
+
+class WriteError(Exception):
+    """
+    Partitions that failed during a write, [(Table, exception), ]
+    """
+
+    def __init__(self, failures, stats=None):
+        self.failures = failures
+        self.stats = stats
+
+        super().__init__("{} partition(s) failed: {}".format(
+            len(failures), ", ".join("{}: {}".format(table.name, exc) for table, exc in failures)))
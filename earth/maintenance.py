@@ -1,62 +1,130 @@
+import argparse
+import datetime
+from collections import defaultdict
+
 from tqdm import tqdm
 
 from earth.base.database import Database
-from earth.base.register import Register
-from earth.settings import SCHEMA_NAME, TIME_FIELD
+from earth.base.dedup import Deduplicator
+from earth.base.encoding import decode_binary_ticks
+from earth.base.reader import QueryBuilder
+from earth.base.register import Register, granularity_of
+from earth.base.register_models import DateRange, Label, Table
+from earth.base.rollup import Rollups
+from earth.base.symbols import SymbolRegistry
+from earth.scheduler import MaintenanceScheduler
+from earth.settings import PARTITION_INTERVALS, RETENTION_POLICIES, SCHEMA_NAME, STORAGE_MODE, TIME_FIELD
+from earth.utils import bin_of
 
 
 class Maintenance:
-    def __init__(self):
+    def __init__(self, workers=None):
         self.db = Database()
         self.register = Register()
+        self.scheduler = MaintenanceScheduler(workers)
+
+    def run(self, full=False):
+        """
+        Only the partitions written since the last run are processed,
+        full=True processes every partition. Returns the stage reports.
+        """
+        worker = Maintenance(self.scheduler.workers)
 
-    def run(self):
-        worker = Maintenance()
+        worker.sync_catalog(full=full)
+        worker.enforce_retention()
 
-        worker.remove_duplicates()
+        dirty = worker.register.dirty_tables()
+        tables = None if full else list(dirty)
+
+        worker.remove_duplicates(tables)
         worker.drop_empty_tables()
 
-        worker.create_indexes()
-        worker.vacuum_database()
+        if tables is not None:
+            tables = [table for table in tables if worker.register.has_table(table)]
 
-    def remove_duplicates(self):
-        queries = []
+        worker.create_indexes(tables)
+        worker.seal_partitions()
+        worker.vacuum_database(tables)
 
-        for full_table_name in self.db.table_list(full_name=True):
-            queries.append("""
-                DELETE FROM {table_name} T1
-                USING {table_name} T2
-                WHERE T1.ctid < T2.ctid 
-                  AND T1.{time_field} = T2.{time_field};
-            """.format(table_name=full_table_name, time_field=TIME_FIELD))
+        # failed tables stay dirty for the next run
+        failed = set(table for report in worker.scheduler.reports for table, _ in report["failures"])
+        worker.register.mark_clean({table: row_count for table, row_count in dirty.items() if table not in failed})
+
+        return worker.scheduler.reports
+
+    def sync_catalog(self, full=False):
+        """
+        Adds the tables missing from earth.partitions, drops rows of
+        tables that are gone. full=True recounts every table.
+        """
+        catalog = self.register.catalog
+
+        # archived partitions have no table anymore
+        known = set(partition.table.name for partition in catalog.load() if not partition.archived)
+        existing = set(self.db.table_list())
+
+        for table_name in tqdm(existing if full else existing - known, desc="sync_catalog"):
+            catalog.sync(Table.from_key(table_name))
+
+        catalog.remove(Table.from_key(table_name) for table_name in known - existing)
+
+        self.register.refresh()
+
+    def target_tables(self, tables=None):
+        # every table when no tables are given
+        if tables is None:
+            return [Table.from_key(table_name) for table_name in self.db.table_list()]
+
+        return list(tables)
+
+    def remove_duplicates(self, tables=None, since=None):
+        """
+        One window function scan per table, since limits it to the recent rows.
+        The results are {"table", "removed", "seconds"}, the catalog counts are corrected.
+        """
+        deduplicator = Deduplicator(self.db)
+
+        def remove_table_duplicates(table):
+            result = deduplicator.remove(table.full_name, since=since)
 
-        self.db.run_multiple_queries_iter(queries, desc="remove_duplicates")
+            if result["removed"]:
+                self.register.record_removal(table, result["removed"])
+
+            return result
+
+        return self.scheduler.run_stage("remove_duplicates", self.target_tables(tables), remove_table_duplicates)
 
     def drop_empty_tables(self):
         queries = []
+        empty_tables = []
 
-        for full_table_name in tqdm(self.db.table_list(full_name=True), desc="detect_empty"):
-            item_count = self.db.table_size(full_table_name)
+        for table in tqdm(self.register.tables, desc="detect_empty"):
+            # catalog row counts first, COUNT(*) only for unknown tables
+            stats = self.register.partition_stats(table)
+            item_count = stats.row_count if stats and stats.row_count is not None else self.db.table_size(
+                table.full_name)
 
             if item_count == 0:
+                empty_tables.append(table)
                 queries.append("""
                     DROP TABLE IF EXISTS {table_name}
-                """.format(table_name=full_table_name, time_field=TIME_FIELD))
+                """.format(table_name=table.full_name))
 
         self.db.run_multiple_queries_iter(queries, desc="drop_empty")
+        self.register.catalog.remove(empty_tables)
+        self.register.refresh()
 
-    def create_indexes(self):
-        queries = []
-
-        for table_name in self.db.table_list():
-            full_table_name = SCHEMA_NAME + "." + table_name
+    def create_indexes(self, tables=None):
+        return self.scheduler.run_stage("create_indexes", self.target_tables(tables), self.create_table_index)
 
-            queries.append(
-                "CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_event_at_idx ON {full_table_name} ({time_field} ASC)".format(
-                    table_name=table_name, full_table_name=full_table_name, time_field=TIME_FIELD)
-            )
-
-        self.db.run_multiple_queries_iter(queries, desc="create_indexes")
+    def create_table_index(self, table):
+        try:
+            self.db.run_autocommit(table.concurrent_index_query)
+        except Exception:
+            # a failed concurrent build leaves an invalid index behind,
+            # IF NOT EXISTS would skip it forever
+            self.db.run_autocommit("DROP INDEX CONCURRENTLY IF EXISTS {}.{}".format(SCHEMA_NAME, table.index_name))
+            raise
 
     def drop_all_tables(self):
         queries = []
@@ -66,20 +134,361 @@ class Maintenance:
             queries.append(query)
 
         self.db.run_multiple_queries_iter(queries, "drop_all")
+        self.register.archive.remove(self.register.tables)
+        self.register.catalog.remove(self.register.tables)
+        self.register.refresh()
+
+    def vacuum_database(self, tables=None):
+        return self.scheduler.run_stage("vacuum", self.target_tables(tables), self.vacuum_table)
+
+    def vacuum_table(self, table):
+        self.db.run_autocommit("VACUUM ANALYZE {}".format(table.full_name))
+
+    ###########################
+
+    # sealing
+
+    def seal_partitions(self, short_codes=None):
+        """
+        Seals every closed partition that is not sealed or archived yet
+        """
+        current_time = datetime.datetime.now()
+        keys = set(Label.make_key(short_code) for short_code in short_codes) if short_codes is not None else None
+
+        tables = [table for table in self.register.tables
+                  if table.date_range.finish < current_time
+                  and not self.register.is_archived(table) and not self.register.is_sealed(table)
+                  and (keys is None or table.label.machine_key in keys)]
+
+        return self.scheduler.run_stage("seal", tables, self.seal_partition)
+
+    def seal_partition(self, table):
+        """
+        Rewrites a closed partition in event_at order as a logged table with
+        the unique and a brin index on event_at. Writes to it skip fetching
+        the stored ticks. Returns the number of removed duplicates.
+        """
+        self.register.catalog.create_table()
+
+        with self.db.transaction() as conn:
+            # the unique index can not be built over duplicates
+            response = self.db.run_query(Deduplicator(self.db).make_query(table.full_name), conn=conn)
+            removed = response[0]["removed_count"] if response else 0
+
+            self.db.run_multiple_queries([
+                table.index_query,
+                "CLUSTER {table_name} USING {index_name}".format(
+                    table_name=table.full_name, index_name=table.index_name),
+                "ALTER TABLE {} SET LOGGED".format(table.full_name),
+                table.brin_index_query,
+                self.register.catalog.seal_query(table),
+            ], conn=conn)
+
+            if removed:
+                self.register.catalog.remove_rows(table, removed, conn=conn)
+
+        self.db.invalidate(table.full_name)
+        self.register.partition_index.remove_rows(table, removed)
+
+        stats = self.register.partition_stats(table)
+
+        if stats is not None:
+            stats.sealed = True
+
+        return removed
+
+    ###########################
+
+    # repartitioning
+
+    def repartition(self, short_codes=None):
+        labels = self.register.labels
+
+        if short_codes is not None:
+            keys = set(Label.make_key(short_code) for short_code in short_codes)
+            labels = [label for label in labels if label.machine_key in keys]
+
+        for label in tqdm(labels, desc="repartition"):
+            self.repartition_label(label)
+
+    def repartition_label(self, label):
+        """
+        Splits or merges the partitions of a label into the target granularity,
+        everything runs in one transaction
+        """
+        tables = [table for table in self.register.partition_index.label_tables(label.machine_key)
+                  if not self.register.is_archived(table)]
+        stats = {table: self.table_stats(table) for table in tables}
+        filled = {table: item for table, item in stats.items() if item["count_val"]}
+
+        if not filled:
+            return None
+
+        row_count = sum(item["count_val"] for item in filled.values())
+        span = max(item["max_at"] for item in filled.values()) - min(item["min_at"] for item in filled.values())
+
+        target = self.register.target_granularity(label, row_count, span.total_seconds())
+
+        if all(granularity_of(table.date_range) == target for table in tables):
+            return None
+
+        interval_seconds = PARTITION_INTERVALS[target].total_seconds()
 
-    def vacuum_database(self):
         queries = []
+        staging_tables = {}
 
-        for full_table_name in self.db.table_list(full_name=True):
-            queries.append("VACUUM ANALYZE {}".format(full_table_name))
+        for table, item in filled.items():
+            for current_bin in range(bin_of(item["min_at"], interval_seconds),
+                                     bin_of(item["max_at"], interval_seconds) + 1):
+                new_table = Table.from_value(label, DateRange.from_bin(current_bin, interval_seconds))
+                staging_name = new_table.name + "_repartition"
+
+                if new_table not in staging_tables:
+                    staging_tables[new_table] = staging_name
+                    queries.append("CREATE UNLOGGED TABLE {schema}.{staging} (LIKE {table_name} INCLUDING DEFAULTS)".format(
+                        schema=SCHEMA_NAME, staging=staging_name, table_name=table.full_name))
+
+                # rows are routed by their seconds since epoch, so the bounds are utc
+                queries.append("""
+                    INSERT INTO {schema}.{staging}
+                    SELECT DISTINCT ON ({time_field}) * FROM {table_name}
+                    WHERE {time_field} >= '{start}' AND {time_field} < '{finish}'
+                """.format(
+                    schema=SCHEMA_NAME, staging=staging_name, table_name=table.full_name, time_field=TIME_FIELD,
+                    start=datetime.datetime.utcfromtimestamp(current_bin * interval_seconds),
+                    finish=datetime.datetime.utcfromtimestamp((current_bin + 1) * interval_seconds)))
+
+        for table in tables:
+            queries.append("DROP TABLE IF EXISTS {}".format(table.full_name))
+
+        queries.append(self.register.catalog.remove_query(tables))
+
+        for new_table, staging_name in staging_tables.items():
+            queries.append("ALTER TABLE {schema}.{staging} RENAME TO {name}".format(
+                schema=SCHEMA_NAME, staging=staging_name, name=new_table.name))
+            queries.append(new_table.index_query)
+
+            if STORAGE_MODE == "native":
+                queries.append("""
+                    ALTER TABLE {parent_name} ATTACH PARTITION {table_name}
+                    FOR VALUES FROM ('{start}') TO ('{finish}')
+                """.format(parent_name=new_table.parent_full_name, table_name=new_table.full_name,
+                           start=new_table.date_range.utc_start, finish=new_table.date_range.utc_finish))
+
+            queries.append(self.register.catalog.sync_query(new_table))
+
+        self.register.catalog.create_table()
+        self.db.run_multiple_queries(queries)
+        self.register.refresh()
+
+        return target
+
+    ###########################
+
+    # archiving
+
+    def archive_partitions(self, short_codes=None):
+        """
+        Moves every closed partition into the compressed archive
+        """
+        current_time = datetime.datetime.now()
+        keys = set(Label.make_key(short_code) for short_code in short_codes) if short_codes is not None else None
+
+        tables = [table for table in self.register.tables
+                  if table.date_range.finish < current_time and not self.register.is_archived(table)
+                  and (keys is None or table.label.machine_key in keys)]
+
+        return sum(self.archive_partition(table) for table in tqdm(tables, desc="archive"))
+
+    def archive_partition(self, table):
+        """
+        Re-encodes the partition into earth.archive chunks and drops its table,
+        reads decode the chunks transparently. Returns the archived row count.
+        """
+        self.register.catalog.create_table()
+        self.register.archive.create_table()
+
+        with self.db.transaction() as conn:
+            # writers wait until the table is gone, reads go on
+            self.db.run_query("LOCK TABLE {} IN EXCLUSIVE MODE".format(table.full_name), conn=conn)
+
+            data = self.db.copy_to("""
+                SELECT DISTINCT ON ({time_field}) {fields} FROM {table_name} ORDER BY {time_field}
+            """.format(time_field=TIME_FIELD, fields=QueryBuilder.ARRAY_FIELDS, table_name=table.full_name),
+                conn=conn)
+
+            event_at, current_value, current_volume = decode_binary_ticks(data)
+
+            if not len(event_at):
+                return 0
+
+            row_count = len(event_at)
+            min_event_at, max_event_at = event_at[0].item(), event_at[-1].item()
+
+            self.register.archive.write(table, event_at, current_value, current_volume, conn=conn)
+
+            self.db.run_query("DROP TABLE {}".format(table.full_name), conn=conn)
+            self.db.run_query(self.register.catalog.archive_query(
+                table, row_count, min_event_at, max_event_at), conn=conn)
+
+        self.db.invalidate(table.full_name, created=True)
+
+        if STORAGE_MODE == "native":
+            self.db.invalidate(table.parent_full_name)
+
+        stats = self.register.partition_stats(table)
+
+        if stats is not None:
+            stats.row_count, stats.min_event_at, stats.max_event_at = row_count, min_event_at, max_event_at
+            stats.archived = True
+
+        return row_count
+
+    ###########################
+
+    # rollups
+
+    def rebuild_rollups(self, short_codes=None):
+        """
+        Builds the rollups from the stored ticks, e.g. for data
+        written before the rollups existed
+        """
+        rollups = Rollups()
+        keys = set(Label.make_key(short_code) for short_code in short_codes) if short_codes is not None else None
+
+        tables = [table for table in self.register.tables
+                  if not self.register.is_archived(table) and (keys is None or table.label.machine_key in keys)]
+
+        for table in tqdm(tables, desc="rollups"):
+            stats = self.register.partition_stats(table)
+
+            if stats is None or stats.row_count is None:
+                item = self.table_stats(table)
+                min_event_at, max_event_at = item["min_at"], item["max_at"]
+            else:
+                min_event_at, max_event_at = stats.min_event_at, stats.max_event_at
+
+            if min_event_at is not None:
+                rollups.update(table.label, min_event_at, max_event_at)
+
+    ###########################
+
+    # retention
+
+    def retention_policy(self, label):
+        symbol = SymbolRegistry().get(label.machine_key)
+        category = symbol.category if symbol is not None else None
+
+        for key in (label.machine_key, category, "default"):
+            if key is not None and key in RETENTION_POLICIES:
+                return dict(dict(raw=None, rollups={}), **RETENTION_POLICIES[key])
+
+        return dict(raw=None, rollups={})
+
+    def enforce_retention(self, current_time=None):
+        """
+        Rolls expired raw partitions up and drops them, then deletes
+        expired rollup rows. Returns {"partitions", "rollup_rows"}
+        """
+        current_time = datetime.datetime.now() if current_time is None else current_time
+        rollups = Rollups()
+
+        expired = []
+
+        for table in self.register.tables:
+            keep = self.retention_policy(table.label)["raw"]
+
+            # whole partitions only, a partly expired one waits
+            if keep is not None and table.date_range.finish < current_time - keep:
+                expired.append(table)
+
+        for table in tqdm(expired, desc="retention"):
+            self.expire_partition(table, rollups)
+
+        return dict(partitions=len(expired), rollup_rows=self.expire_rollups(rollups, current_time))
+
+    def expire_partition(self, table, rollups):
+        archived = self.register.is_archived(table)
+        stats = self.register.partition_stats(table)
+
+        if stats is None or stats.row_count is None:
+            item = self.table_stats(table)
+            min_event_at, max_event_at = item["min_at"], item["max_at"]
+        else:
+            min_event_at, max_event_at = stats.min_event_at, stats.max_event_at
+
+        self.register.catalog.create_table()
+
+        with self.db.transaction() as conn:
+            # the buckets are rebuilt from the raw ticks before they go,
+            # archived partitions were rolled up while they were written
+            if not archived and min_event_at is not None:
+                rollups.update(table.label, min_event_at, max_event_at, conn=conn)
+
+            if archived:
+                self.db.run_query(self.register.archive.remove_query([table]), conn=conn)
+            else:
+                self.db.run_query("DROP TABLE IF EXISTS {}".format(table.full_name), conn=conn)
+
+            self.db.run_query(self.register.catalog.remove_query([table]), conn=conn)
+
+        self.register.remove_table(table)
+        self.db.invalidate(table.full_name, created=True)
+
+        if STORAGE_MODE == "native":
+            self.db.invalidate(table.parent_full_name)
+
+    def expire_rollups(self, rollups, current_time):
+        # symbols keep their rollups after their last partition is dropped
+        keys = set(label.machine_key for label in self.register.labels)
+        keys.update(Label.make_key(symbol.short_code) for symbol in SymbolRegistry().all())
+
+        cutoffs = defaultdict(list)
+
+        for key in keys:
+            for resolution, keep in self.retention_policy(Label.from_key(key))["rollups"].items():
+                if keep is not None and resolution in rollups.resolutions:
+                    cutoffs[(resolution, current_time - keep)].append(key)
+
+        if not cutoffs:
+            return 0
+
+        rollups.create_tables()
+        row_count = 0
+
+        for (resolution, cutoff), short_codes in cutoffs.items():
+            response = self.db.run_query("""
+                WITH removed AS (
+                    DELETE FROM {table_name}
+                    WHERE short_code IN %s AND bucket_at < %s
+                    RETURNING 1
+                )
+                SELECT COUNT(*) AS removed_count FROM removed
+            """.format(table_name=rollups.full_table_name(resolution)), (tuple(sorted(short_codes)), cutoff))
+
+            row_count += response[0]["removed_count"] if response else 0
+
+        return row_count
+
+    def table_stats(self, table):
+        response = self.db.run_query("""
+            SELECT COUNT(*) AS count_val, MIN({time_field}) AS min_at, MAX({time_field}) AS max_at
+            FROM {table_name}
+        """.format(time_field=TIME_FIELD, table_name=table.full_name))
+
+        return response[0]
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Maintains the partitions written since the last run")
+    parser.add_argument("--full", action="store_true", help="process every partition")
+    args = parser.parse_args()
 
-        conn = self.db.connection_pool.getconn()
-        old_isolation_level = conn.isolation_level
-        conn.set_isolation_level(0)
+    for report in Maintenance().run(full=args.full):
+        print("{stage}: {tables} tables in {seconds:.1f}s, {failures} failed".format(
+            stage=report["stage"], tables=report["tables"], seconds=report["seconds"],
+            failures=len(report["failures"])))
 
-        cur = conn.cursor()
-        for query in tqdm(queries, desc="vacuum"):
-            cur.execute(query)
 
-        conn.set_isolation_level(old_isolation_level)
-        self.db.connection_pool.putconn(conn)
+if __name__ == '__main__':
+    run()
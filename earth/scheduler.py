@@ -0,0 +1,67 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from earth.base.database import Database
+from earth.base.register import Register
+from earth.settings import MAINTENANCE_WORKERS
+
+
+class MaintenanceScheduler:
+    """
+    Runs one maintenance stage over many tables in parallel, largest
+    tables first, with at most MAINTENANCE_WORKERS[stage] statements
+    in flight. Every statement takes its own pooled connection.
+    """
+
+    def __init__(self, workers=None):
+        self.db = Database()
+        self.register = Register()
+
+        self.workers = dict(MAINTENANCE_WORKERS, **(workers or {}))
+
+        # one report per finished stage
+        self.reports = []
+
+    def order(self, tables):
+        # the largest tables take longest, starting them first shortens the stage
+        def row_count(table):
+            stats = self.register.partition_stats(table)
+            return stats.row_count if stats is not None and stats.row_count is not None else 0
+
+        return sorted(tables, key=row_count, reverse=True)
+
+    def run_stage(self, stage, tables, task):
+        """
+        Calls task(table) for every table, returns the stage report:
+        {"stage", "tables", "seconds", "table_seconds": {Table: seconds},
+         "results": {Table: result}, "failures": [(Table, exception), ]}
+        """
+        tables = self.order(tables)
+        workers = max(self.workers.get(stage, 1), 1)
+
+        report = dict(stage=stage, tables=len(tables), seconds=0.0, table_seconds={}, results={}, failures=[])
+        started_at = time.perf_counter()
+
+        def timed(table):
+            table_started_at = time.perf_counter()
+            result = task(table)
+
+            return result, time.perf_counter() - table_started_at
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            future_to_table = {pool.submit(timed, table): table for table in tables}
+
+            for future in tqdm(as_completed(future_to_table), total=len(tables), desc=stage):
+                table = future_to_table[future]
+
+                try:
+                    report["results"][table], report["table_seconds"][table] = future.result()
+                except Exception as exc:
+                    report["failures"].append((table, exc))
+
+        report["seconds"] = time.perf_counter() - started_at
+        self.reports.append(report)
+
+        return report
@@ -7,6 +7,7 @@ from tqdm import tqdm
 import venus
 import venus.objects
 import venus.utils
+from earth.base.dedup import Deduplicator
 
 venus.setup()
 
@@ -90,13 +91,7 @@ class CoinMarketCap:
         venus.qb.save_data(data, "stock.coinmarketcap", debug=True, do_single=True)
 
     def remove_duplicates(self):
-        venus.db.run_query("""
-            DELETE FROM {table_name} T1
-            USING {table_name} T2
-            WHERE T1.ctid < T2.ctid 
-              AND T1.event_at = T2.event_at 
-              AND T1.short_code = T2.short_code;
-        """.format(table_name="stock.coinmarketcap"))
+        return Deduplicator(venus.db).remove("stock.coinmarketcap", key_fields=("short_code", "event_at"))
 
 
 if __name__ == '__main__':
@@ -4,6 +4,7 @@ import json
 import venus
 import venus.objects
 import venus.utils
+from earth.base.dedup import Deduplicator
 
 venus.setup()
 
@@ -30,16 +31,20 @@ class Spider:
 
     def update(self):
         self.use_cache = False
-        return self._collect(["minute"])
 
-    def _collect(self, interval_list):
+        # minute ticks only reach 2000 * 3 minutes back, older rows are left alone
+        since = datetime.datetime.now() - datetime.timedelta(minutes=2000 * 3)
+
+        return self._collect(["minute"], since=since)
+
+    def _collect(self, interval_list, since=None):
         coins = self._symbol_list()
 
         for interval in interval_list:
             ticks_data = self._fetch_ticks(coins, interval)
             venus.qb.save_data(ticks_data, self.table_name, debug=True)
 
-        self._remove_duplicates()
+        self._remove_duplicates(since=since)
 
     def _symbol_list(self, max_order=10000):
         response = venus.objects.Request(
@@ -99,14 +104,8 @@ class Spider:
 
         return result
 
-    def _remove_duplicates(self):
-        venus.db.run_query("""
-            DELETE FROM {table_name} T1
-            USING {table_name} T2
-            WHERE T1.ctid < T2.ctid 
-              AND T1.full_name = T2.full_name 
-              AND T1.event_at = T2.event_at;
-        """.format(table_name=self.table_name))
+    def _remove_duplicates(self, since=None):
+        return Deduplicator(venus.db).remove(self.table_name, key_fields=("full_name", "event_at"), since=since)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,8 @@
 import datetime
 from pprint import pprint
 
+import numpy as np
+
 from earth.base import Earth
 
 
@@ -24,11 +26,9 @@ class Finance:
             start_date=start_date)
 
     def last_tick(self, short_code):
-        end_date = datetime.datetime.now()
-
+        # served from the latest value cache
         return self.engine.reader.read_last(
-            short_code=short_code,
-            end_date=end_date)
+            short_code=short_code)
 
     def historical_tick(self, short_code, hours_ago=24):
         # Returns the oldest item since hours ago
@@ -57,6 +57,9 @@ class Finance:
         price_last = self.last_price(short_code)
         price_historical = self.historical_price(short_code, hours_ago)
 
+        return self.make_change(price_last, price_historical)
+
+    def make_change(self, price_last, price_historical):
         price_last = 0 if not price_last else price_last
         price_historical = price_last if not price_historical else price_historical
 
@@ -71,15 +74,147 @@ class Finance:
     ######################################################
 
     def sort_by_change(self, hours_ago=24 * 7):
-        changes = []
+        # three queries for the whole universe: last ticks, historical ticks, metadata
+        data = self.universe(hours_ago)
+
+        # same rules as make_change, missing prices give no change
+        price_last = np.nan_to_num(data["last_value"], nan=0.0)
+        price_historical = np.where(np.nan_to_num(data["first_value"], nan=0.0) != 0, data["first_value"], price_last)
+
+        price_diff = price_last - price_historical
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percentage = np.where(price_historical > 0, 100 * price_diff / price_historical, 0.0)
+
+        metadata = self.engine.reader.register.metadata_by_labels(data["labels"])
+
+        return [{
+            "symbol": metadata.get(data["labels"][index].machine_key, []),
+            "change": {"diff": price_diff[index].item(), "percentage": percentage[index].item()}
+        } for index in np.argsort(-percentage, kind="stable")]
+
+    ######################################################
+
+    def universe(self, hours_ago=24, series=False):
+        """
+        First and last values of every label over the horizon as arrays aligned
+        with data["labels"], missing ones are nan. series=True also loads every
+        tick of the horizon in one query for the volatility.
+        """
+        reader = self.engine.reader
+
+        current_time = datetime.datetime.now()
+        start_date = current_time - datetime.timedelta(hours=hours_ago)
+
+        labels = list(reader.register.labels)
+        short_codes = [label.value for label in labels]
+
+        last_ticks = reader.read_last_many(short_codes)
+        first_ticks = reader.read_first_many(short_codes, start_date=start_date, end_date=current_time)
+
+        data = dict(
+            labels=labels,
+            short_codes=np.array(short_codes, dtype=object),
+            first_value=edge_values(first_ticks, short_codes, "current_value"),
+            last_value=edge_values(last_ticks, short_codes, "current_value"),
+            first_volume=edge_values(first_ticks, short_codes, "current_volume"),
+            last_volume=edge_values(last_ticks, short_codes, "current_volume"),
+        )
+
+        if series:
+            ticks = reader.read_many(short_codes, start_date=start_date, end_date=current_time)
+            data["volatility"] = series_volatility(ticks, short_codes)
+
+        return data
+
+    def analytics(self, hours_ago=24, series=True):
+        """
+        Change, percentage, log return, volume change (percent) and
+        volatility (standard deviation of the tick log returns) of every
+        label, each an array aligned with data["labels"]
+        """
+        data = self.universe(hours_ago, series)
+
+        first_value, last_value = data["first_value"], data["last_value"]
+        first_volume, last_volume = data["first_volume"], data["last_volume"]
+
+        # nan compares false, so missing values stay nan
+        with np.errstate(divide="ignore", invalid="ignore"):
+            data["change"] = last_value - first_value
+            data["percentage"] = np.where(first_value > 0, 100 * data["change"] / first_value, np.nan)
+            data["log_return"] = np.where((first_value > 0) & (last_value > 0), np.log(last_value / first_value), np.nan)
+            data["volume_change"] = np.where(first_volume > 0, 100 * (last_volume - first_volume) / first_volume, np.nan)
+
+        if "volatility" not in data:
+            data["volatility"] = np.full(len(first_value), np.nan)
+
+        return data
+
+    def top_movers(self, hours_ago=24, count=20, by="percentage"):
+        """
+        The count labels with the largest absolute value of the analytics field,
+        volatility is ranked as it is. Labels without a value are left out.
+        """
+        data = self.analytics(hours_ago, series=by == "volatility")
+
+        scores = data[by] if by == "volatility" else np.abs(data[by])
+        scores = np.where(np.isnan(scores), -np.inf, scores)
+
+        count = min(count, len(scores))
+
+        if not count:
+            return []
+
+        # partial selection, only the winners are sorted
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        top = top[np.isfinite(scores[top])]
+
+        metadata = self.engine.reader.register.metadata_by_labels([data["labels"][index] for index in top])
+        fields = ["first_value", "last_value", "change", "percentage", "log_return", "volume_change", "volatility"]
+
+        return [dict(
+            symbol=metadata.get(data["labels"][index].machine_key, []),
+            short_code=data["short_codes"][index],
+            **{field: data[field][index].item() for field in fields}
+        ) for index in top]
+
+
+def edge_values(ticks, short_codes, field):
+    # {short_code: Tick} to a float array aligned with short_codes
+    values = (getattr(ticks[short_code], field) if short_code in ticks else None for short_code in short_codes)
+
+    return np.fromiter((np.nan if value is None else value for value in values), dtype=np.float64, count=len(short_codes))
+
+
+def series_volatility(ticks, short_codes):
+    """
+    Sample standard deviation of the tick to tick log returns of every
+    short code, all series are flattened and reduced with bincount
+    """
+    lengths = [len(ticks.get(short_code, [])) for short_code in short_codes]
+
+    values = np.fromiter(
+        (np.nan if tick.current_value is None else tick.current_value
+         for short_code in short_codes for tick in ticks.get(short_code, [])),
+        dtype=np.float64, count=sum(lengths))
+    owners = np.repeat(np.arange(len(short_codes)), lengths)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        returns = np.diff(np.log(values))
+
+    # a return belongs to a series when both ticks do
+    valid = (owners[1:] == owners[:-1]) & np.isfinite(returns)
+    returns, owners = returns[valid], owners[1:][valid]
+
+    counts = np.bincount(owners, minlength=len(short_codes))
+    sums = np.bincount(owners, weights=returns, minlength=len(short_codes))
+    squares = np.bincount(owners, weights=returns ** 2, minlength=len(short_codes))
 
-        for label in self.engine.reader.register.labels:
-            changes.append({
-                "symbol": label.metadata,
-                "change": self.calculate_change(label.value, hours_ago)
-            })
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = (squares - sums ** 2 / counts) / (counts - 1)
 
-        return list(sorted(changes, key=lambda x: x["change"]["percentage"], reverse=True))
+    return np.where(counts > 1, np.sqrt(np.maximum(variance, 0)), np.nan)
 
 
 def run():
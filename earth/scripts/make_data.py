@@ -1,5 +1,5 @@
 import venus
-from earth.base import Earth
+from earth.base import Database, Earth
 from earth.base.io_models import Symbol, Tick
 from earth.maintenance import Maintenance
 
@@ -16,24 +16,31 @@ class Generator:
         pass
 
     def generate(self):
-        result = {}
+        # yields one symbol at a time, rows arrive ordered by short_code
+        current = None
 
-        raw_data = self._get_raw_data("stock.coinmarketcap", limit=False)
-
-        for row in raw_data:
+        for row in self._iter_raw_data("stock.coinmarketcap"):
             short_code = row["short_code"]
 
-            if short_code not in result:
-                symbol = self._make_symbol(row)
+            if current is None or current["symbol"].short_code != short_code:
+                if current is not None:
+                    yield current
 
-                result[short_code] = {
-                    "symbol": symbol,
+                current = {
+                    "symbol": self._make_symbol(row),
                     "ticks": []
                 }
 
-            result[short_code]["ticks"].append(self._make_tick(row))
+            current["ticks"].append(self._make_tick(row))
+
+        if current is not None:
+            yield current
+
+    def _iter_raw_data(self, table_name):
+        query = "SELECT * FROM {} ORDER BY short_code, event_at".format(table_name)
 
-        return result
+        for rows in Database().stream_query(query):
+            yield from rows
 
     def _get_raw_data(self, table_name, limit=False):
         if limit:
@@ -73,13 +80,12 @@ class Generator:
 def run():
     crawl()
 
-    stock_data = Generator().generate()
     engine = Earth()
 
-    for symbol_key in stock_data:
+    for stock_data in Generator().generate():
         engine.writer.write(
-            symbol=stock_data[symbol_key]["symbol"],
-            ticks=stock_data[symbol_key]["ticks"],
+            symbol=stock_data["symbol"],
+            ticks=stock_data["ticks"],
         )
 
     Maintenance().run()
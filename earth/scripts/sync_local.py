@@ -0,0 +1,67 @@
+import argparse
+import datetime
+
+from tqdm import tqdm
+
+from earth.base import Database, LocalStore, QueryBuilder, Register, decode_binary_ticks
+from earth.base.register_models import Label
+from earth.settings import LOCAL_STORE_PATH, TIME_FIELD
+
+
+class LocalSync:
+    """
+    Exports the database partitions into a LocalStore, closed partitions
+    whose local row count matches the catalog are skipped
+    """
+
+    def __init__(self, path=LOCAL_STORE_PATH):
+        self.db = Database()
+        self.register = Register()
+        self.store = LocalStore(path)
+
+    def sync(self, short_codes=None, full=False):
+        tables = sorted(self.register.tables, key=lambda table: (table.label.machine_key, table.date_range.start))
+
+        if short_codes is not None:
+            keys = set(Label.make_key(short_code) for short_code in short_codes)
+            tables = [table for table in tables if table.label.machine_key in keys]
+
+        current_time = datetime.datetime.now()
+        row_count = 0
+
+        for table in tqdm(tables, desc="sync_local"):
+            stats = self.register.partition_stats(table)
+            closed = table.date_range.finish < current_time
+
+            if not full and closed and stats is not None and stats.row_count == self.store.row_count(table):
+                continue
+
+            row_count += self.sync_table(table)
+
+        return row_count
+
+    def sync_table(self, table):
+        if self.register.is_archived(table):
+            event_at, current_value, current_volume = self.register.archive.read(table)
+        else:
+            data = self.db.copy_to("""
+                SELECT DISTINCT ON ({time_field}) {fields} FROM {table_name} ORDER BY {time_field}
+            """.format(time_field=TIME_FIELD, fields=QueryBuilder.ARRAY_FIELDS, table_name=table.full_name))
+
+            event_at, current_value, current_volume = decode_binary_ticks(data)
+
+        return self.store.replace(table, event_at, current_value, current_volume)
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Export the tick partitions into the local store")
+    parser.add_argument("short_codes", nargs="*", help="symbols to export, all of them by default")
+    parser.add_argument("--path", default=LOCAL_STORE_PATH)
+    parser.add_argument("--full", action="store_true", help="export closed partitions again")
+    args = parser.parse_args()
+
+    LocalSync(args.path).sync(args.short_codes or None, full=args.full)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,207 @@
+import datetime
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from earth.base.cache import CATALOG_TABLE, QueryCache
+from earth.base.encoding import decode_binary_ticks, decode_tick_chunk, encode_binary, encode_tick_chunk
+from earth.base.io_models import Tick
+from earth.base.partition_index import PartitionIndex
+from earth.base.register import Register
+from earth.base.register_models import DateRange, Label, Partition, Table
+from earth.settings import PARTITION_INTERVALS
+
+
+class TestTickChunk(unittest.TestCase):
+    def assertRoundTrip(self, event_at, current_value, current_volume):
+        decoded = decode_tick_chunk(encode_tick_chunk(event_at, current_value, current_volume))
+
+        np.testing.assert_array_equal(decoded[0], event_at)
+        # bit for bit, nan payloads and the sign of zero included
+        np.testing.assert_array_equal(decoded[1].view(np.int64), current_value.view(np.int64))
+        np.testing.assert_array_equal(decoded[2], current_volume)
+
+    def test_special_values(self):
+        event_at = np.datetime64("2020-01-01", "us") + np.arange(6) * np.timedelta64(1, "s")
+        current_value = np.array([1.5, np.nan, np.inf, -np.inf, -0.0, 0.0])
+        current_volume = np.array([0, 10, 3, -5, 2 ** 40, -2 ** 62], dtype=np.int64)
+
+        self.assertRoundTrip(event_at, current_value, current_volume)
+
+    def test_negative_deltas(self):
+        # irregular gaps give negative delta of deltas, also going back in time
+        event_at = np.array(["2020-01-01T00:00:00", "2020-01-01T01:00:00", "2020-01-01T01:00:00.000001",
+                             "2019-12-31T00:00:00", "2030-01-01T00:00:00"], dtype="datetime64[us]")
+        current_value = np.array([100.0, 99.5, 101.25, 1e-300, 1e300])
+        current_volume = np.array([1000, 1, 500, 0, 7], dtype=np.int64)
+
+        self.assertRoundTrip(event_at, current_value, current_volume)
+
+    def test_empty_chunk(self):
+        self.assertRoundTrip(np.empty(0, dtype="datetime64[us]"), np.empty(0), np.empty(0, dtype=np.int64))
+
+
+class TestBinaryTicks(unittest.TestCase):
+    def test_round_trip(self):
+        rows = [dict(event_at=datetime.datetime(2020, 1, 1, 12, 30, 15, 123456), current_value=-0.5, current_volume=3),
+                dict(event_at=datetime.datetime(1999, 12, 31, 23, 59, 59), current_value=1e10, current_volume=-1)]
+
+        event_at, current_value, current_volume = decode_binary_ticks(
+            encode_binary(rows, ["event_at", "current_value", "current_volume"]).getvalue())
+
+        self.assertEqual(event_at.tolist(), [row["event_at"] for row in rows])
+        self.assertEqual(current_value.tolist(), [row["current_value"] for row in rows])
+        self.assertEqual(current_volume.tolist(), [row["current_volume"] for row in rows])
+
+    def test_empty(self):
+        for data in (None, encode_binary([], ["event_at", "current_value", "current_volume"]).getvalue()):
+            self.assertEqual([len(array) for array in decode_binary_ticks(data)], [0, 0, 0])
+
+
+class TestQueryCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = QueryCache(max_entries=2, max_bytes=10 ** 9, ttl=0)
+
+        cache.set("a", "SELECT * FROM earth.a", [dict(x=1)])
+        cache.set("b", "SELECT * FROM earth.b", [dict(x=2)])
+        cache.get("a")
+        cache.set("c", "SELECT * FROM earth.c", [dict(x=3)])
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), [dict(x=1)])
+        self.assertEqual(cache.stats["evictions"], 1)
+
+    def test_byte_cap(self):
+        cache = QueryCache(max_entries=100, max_bytes=10 ** 9, ttl=0)
+        cache.set("a", "SELECT * FROM earth.a", [dict(x=1)])
+
+        cache.max_bytes = cache.size
+        cache.set("b", "SELECT * FROM earth.b", [dict(x=2)])
+
+        self.assertIsNone(cache.get("a"))
+        self.assertLessEqual(cache.size, cache.max_bytes)
+
+    def test_ttl(self):
+        cache = QueryCache(ttl=10)
+
+        with mock.patch("earth.base.cache.time.monotonic", return_value=100.0):
+            cache.set("a", "SELECT * FROM earth.a", [dict(x=1)])
+
+        with mock.patch("earth.base.cache.time.monotonic", return_value=109.0):
+            self.assertEqual(cache.get("a"), [dict(x=1)])
+
+        with mock.patch("earth.base.cache.time.monotonic", return_value=111.0):
+            self.assertIsNone(cache.get("a"))
+
+        self.assertEqual(cache.stats["entries"], 0)
+
+    def test_invalidation(self):
+        cache = QueryCache(ttl=0)
+
+        cache.set("a", "SELECT * FROM earth.a JOIN earth.b ON true", [dict(x=1)])
+        cache.set("b", "SELECT * FROM earth.b", [dict(x=2)])
+        cache.set("c", "SELECT table_name FROM information_schema.tables", [dict(x=3)])
+
+        cache.invalidate_query("INSERT INTO earth.a (x) VALUES (1)")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), [dict(x=2)])
+
+        cache.invalidate("EARTH.B")
+        self.assertIsNone(cache.get("b"))
+
+        cache.invalidate_query("CREATE TABLE IF NOT EXISTS earth.d (x int)")
+        self.assertIsNone(cache.get("c"))
+        self.assertNotIn(CATALOG_TABLE, cache.table_keys)
+
+
+class TestPartitionIndex(unittest.TestCase):
+    def setUp(self):
+        day = int(PARTITION_INTERVALS["day"].total_seconds())
+        label = Label.from_key("btc")
+
+        # three closed days, the middle one holds ticks around noon only
+        self.tables = [Table.from_value(label, DateRange.from_bin(18262 + offset, day)) for offset in range(3)]
+        self.noon = self.tables[1].date_range.start + datetime.timedelta(hours=12)
+
+        self.index = PartitionIndex([
+            Partition(self.tables[0], row_count=None),
+            Partition(self.tables[1], row_count=2, min_event_at=self.noon,
+                      max_event_at=self.noon + datetime.timedelta(hours=1)),
+            Partition(self.tables[2], row_count=0),
+        ])
+
+    def test_range_boundaries(self):
+        first, second, third = self.tables
+
+        # a range ending on a start or starting on a finish still touches that partition
+        self.assertEqual(self.index.lookup("btc", first.date_range.start, first.date_range.start), [first])
+        self.assertEqual(self.index.lookup("btc", first.date_range.finish, self.noon), [first, second])
+        self.assertEqual(self.index.lookup("btc", third.date_range.finish, third.date_range.finish), [])
+
+    def test_pruning(self):
+        first, second, third = self.tables
+
+        # unknown stats are never pruned, empty partitions always are
+        self.assertEqual(self.index.lookup("btc", first.date_range.start, third.date_range.finish), [first, second])
+
+        # the actual bounds are inclusive
+        self.assertEqual(self.index.lookup("btc", second.date_range.start, self.noon), [first, second])
+        self.assertEqual(self.index.lookup(
+            "btc", second.date_range.start + datetime.timedelta(seconds=1),
+            self.noon - datetime.timedelta(microseconds=1)), [])
+        self.assertEqual(self.index.lookup(
+            "btc", self.noon + datetime.timedelta(hours=1), second.date_range.finish), [second])
+
+    def test_unknown_label(self):
+        self.assertIsNone(self.index.lookup("eth", self.noon, self.noon))
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self):
+        # only the in memory parts of the register, no connection
+        self.register = Register.__new__(Register)
+        self.register.index = PartitionIndex()
+        self.register.loaded_at = time.monotonic()
+        self.register.granularities = dict(btc="day", eth="month")
+        self.register.label_cache = {}
+        self.register.table_cache = {}
+
+    def test_matches_date_range(self):
+        start = datetime.datetime(2019, 12, 30, 22, 0)
+        ticks = [Tick(short_code=short_code, event_at=start + datetime.timedelta(minutes=97 * step),
+                      current_value=float(step), current_volume=step)
+                 for step in range(100) for short_code in ("BTC", "ETH")]
+
+        # duplicates and shuffled input are fine
+        tables = self.register.separate_ticks_to_tables(ticks[::-1] + ticks[:3])
+
+        routed = [(table, tick) for table, content in tables.items() for tick in content]
+        self.assertEqual(len(routed), len(ticks))
+
+        for table, tick in routed:
+            granularity = self.register.granularities[table.label.machine_key]
+            date_range = DateRange.from_timestamp(tick.event_at, PARTITION_INTERVALS[granularity])
+
+            self.assertEqual(table.date_range.machine_key, date_range.machine_key)
+            self.assertEqual(table.label, Label.from_value(tick.short_code))
+
+    def test_refresh_on_miss(self):
+        now = datetime.datetime.now()
+        table = Table.from_value(Label.from_key("btc"), DateRange.from_timestamp(now, PARTITION_INTERVALS["day"]))
+
+        def refresh():
+            self.register.index = PartitionIndex([Partition(table, row_count=None)])
+            self.register.loaded_at = time.monotonic()
+
+        self.register.missed_at = None
+
+        with mock.patch.object(self.register, "refresh", side_effect=refresh) as refreshed, \
+                mock.patch("earth.base.register.SymbolRegistry"):
+            # a label created by another process is found after one reload
+            self.assertEqual(self.register.tables_by_short_code("BTC", now, now), [table])
+
+            # misses are rate limited
+            self.assertEqual(self.register.tables_by_short_codes(["ETH"], now, now), {})
+            self.assertEqual(refreshed.call_count, 1)
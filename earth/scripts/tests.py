@@ -1,6 +1,7 @@
 import unittest
 
 from earth.base.io_models import Tick
+from earth.base.register_models import Label
 from earth.scripts.finance import Finance
 
 
@@ -27,3 +28,12 @@ class TestFinance(unittest.TestCase):
 
     def test_sort_by_change(self):
         self.assertTrue(self.finance.sort_by_change())
+
+    def test_read_last_many(self):
+        ticks = self.finance.engine.reader.read_last_many(["BTC"])
+        self.assertEqual(ticks["BTC"], self.finance.engine.reader.read_last("BTC"))
+
+    def test_metadata_by_labels(self):
+        label = Label.from_key("BTC")
+        metadata = self.finance.engine.reader.register.metadata_by_labels([label])
+        self.assertEqual(metadata["btc"], label.metadata)
@@ -1,3 +1,6 @@
+import datetime
+import os
+
 DB_PARAMS = dict(
     dbname="postgres",
     user="postgres",
@@ -6,6 +9,105 @@ DB_PARAMS = dict(
     port="5432"
 )
 
+POOL_MIN_CONNECTIONS = 1
+POOL_MAX_CONNECTIONS = 20
+
 SCHEMA_NAME = 'earth'
 TIME_FIELD = 'event_at'
 SYMBOLS_TABLE = "symbols"
+LATEST_TABLE = "latest"
+PARTITIONS_TABLE = "partitions"
+ARCHIVE_TABLE = "archive"
+
+# "postgres" or "local", the local backend reads memory mapped column files
+# exported by earth.scripts.sync_local
+STORAGE_BACKEND = "postgres"
+LOCAL_STORE_PATH = os.path.join(os.path.expanduser("~"), ".earth", "ticks")
+
+# query cache
+QUERY_CACHE_MAX_ENTRIES = 1024
+QUERY_CACHE_MAX_BYTES = 256 * 1024 * 1024
+QUERY_CACHE_TTL = 300  # seconds, 0 disables expiry
+
+# partitions and symbols created by other processes are seen after at most
+# REGISTER_TTL seconds, lookup misses reload at most every REGISTER_MISS_INTERVAL seconds
+REGISTER_TTL = 60
+REGISTER_MISS_INTERVAL = 5
+
+# seconds before earth.latest is re-read, for the ticks other writers saved
+LATEST_TTL = 5
+
+# "tables": one plain table per partition, read with UNION ALL
+# "native": partitions of a PARTITION BY RANGE parent per symbol
+STORAGE_MODE = "tables"
+
+# native parents are earth.ticks_<label>, so that no label
+# collides with the tables above or the rollups
+PARENT_TABLE_PREFIX = "ticks_"
+
+# partitions
+PARTITION_INTERVALS = dict(
+    day=datetime.timedelta(days=1),
+    week=datetime.timedelta(days=7),
+    month=datetime.timedelta(days=30),
+    year=datetime.timedelta(days=365),
+)
+DEFAULT_GRANULARITY = "year"
+# per symbol granularity, e.g. {"btc": "month"}, others are chosen from tick density
+PARTITION_GRANULARITY = {}
+# density based choice keeps partitions under this size
+PARTITION_MAX_ROWS = 5000000
+
+# ticks per compressed chunk of an archived partition, chunks are pruned by their time bounds
+ARCHIVE_CHUNK_SIZE = 10000
+
+# OHLC rollups kept up to date by the writer, earth.rollup_<resolution>,
+# coarser resolutions are built from the finest one dividing them
+ROLLUP_RESOLUTIONS = ("1m", "1h", "1d")
+ROLLUP_TABLE_PREFIX = "rollup_"
+
+# retention, looked up by symbol key, then by symbol category, then "default".
+# "raw": age after which whole raw partitions are rolled up and dropped,
+# "rollups": age per rollup resolution, None keeps forever. For example
+# crypto=dict(raw=datetime.timedelta(days=90),
+#             rollups={"1m": datetime.timedelta(days=90), "1h": datetime.timedelta(days=5 * 365), "1d": None})
+RETENTION_POLICIES = dict(
+    default=dict(raw=None, rollups={}),
+)
+
+# rows fetched per round trip by server side cursors
+STREAM_ITERSIZE = 10000
+
+# ingest
+INGEST_MODE = "copy"  # "insert" or "copy"
+COPY_FORMAT = "csv"  # "csv" or "binary"
+COPY_BATCH_SIZE = 50000
+
+# partitions written in parallel, each worker holds one pooled connection
+WRITE_WORKERS = 4
+
+# StreamWriter flushes when this many ticks are buffered or the oldest one waited max_delay seconds,
+# producers block above max_pending
+STREAM_MAX_SIZE = 5000
+STREAM_MAX_DELAY = 1.0
+STREAM_MAX_PENDING = 100000
+
+# maintenance statements running at the same time per stage, each holds one pooled connection
+MAINTENANCE_WORKERS = dict(
+    remove_duplicates=4,
+    create_indexes=2,
+    seal=1,
+    vacuum=2,
+)
+
+# "fetch" compares against stored timestamps in python,
+# "conflict" relies on the unique event_at index
+DEDUP_MODE = "conflict"
+
+# column types of the tick tables, used by binary COPY
+TICK_COLUMNS = dict(
+    short_code="text",
+    event_at="timestamp",
+    current_value="float8",
+    current_volume="int8",
+)
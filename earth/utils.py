@@ -15,6 +15,24 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+INTERVAL_UNITS = dict(s=1, m=60, h=60 * 60, d=24 * 60 * 60, w=7 * 24 * 60 * 60)
+
+
+def interval_in_seconds(interval):
+    """
+    "30s", "5m", "1h", "1d", "1w" -> seconds
+    """
+    if isinstance(interval, datetime.timedelta):
+        return int(interval.total_seconds())
+
+    count, unit = interval[:-1], interval[-1]
+
+    if unit not in INTERVAL_UNITS or not count.isdigit() or int(count) <= 0:
+        raise ValueError("Invalid interval: {}".format(interval))
+
+    return int(count) * INTERVAL_UNITS[unit]
+
+
 def time_in_seconds(dt):
     current_time = datetime.datetime.utcfromtimestamp(0)
     return int((dt - current_time).total_seconds())
@@ -33,7 +51,16 @@ def generate_ranges(timestamp, interval=None):
     return dict(start=start_dt, finish=finish_dt)
 
 
+def bin_of(timestamp, interval_seconds):
+    return int(time_in_seconds(timestamp) / interval_seconds)
+
+
 def from_timestamp(ts):
     ts = int(ts) if type(ts) is str else ts
 
     return datetime.datetime.fromtimestamp(ts)
+
+
+def chunks(items, size):
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
@@ -18,7 +18,7 @@ setup(
     ),
 
     install_requires=[
-        'attrs', 'psycopg2', 'tqdm', 'python-slugify', 'lxml', 'bs4'
+        'attrs', 'numpy', 'psycopg2', 'tqdm', 'lxml', 'bs4'
     ],
 
     project_urls={